@@ -19,21 +19,26 @@ The temporary text file is then deleted and a CSS file is created
 to format the HTML file for readability.
 """
 
+import sys
 import os
 import time
 
 import urllib2
-from json import load
+from json import load, dump
 
+api_url = 'https://api.groupme.com/v3'  # or a stand-in such as a mock server
 message_limit = 100  # cannot be greater than 100
+estimates_name = 'runtime_estimates.json'  # throughput of past retrievals
+estimate_weight = 0.2  # weight of the latest page in runtime estimates
+default_rate = 360.0  # messages/second assumed before any are measured
 
 def get_URL(token, chat_type, chat_ID):
     """Retrieve the URL given an access token, chat type, and an ID."""
     if chat_type == 'group':
-        url = 'https://api.groupme.com/v3/groups/%s/messages' % chat_ID
+        url = '%s/groups/%s/messages' % (api_url, chat_ID)
         url += "?token=%s" % token
     elif chat_type == 'direct':
-        url = 'https://api.groupme.com/v3/direct_messages'
+        url = '%s/direct_messages' % api_url
         url += '?other_user_id=%s' % chat_ID
         url += "&token=%s" % token
 
@@ -50,7 +55,7 @@ def get_json(url):
 
 def get_self_id(token):
     """Obtain a user's ID given their token."""
-    url = "https://api.groupme.com/v3/users/me?token=%s" % token
+    url = "%s/users/me?token=%s" % (api_url, token)
     json = get_json(url)
     user_id = json['response']['user_id']
 
@@ -58,7 +63,7 @@ def get_self_id(token):
     
 def get_groups(token):
     """Return a list of group chats' IDs and names."""
-    url = 'https://api.groupme.com/v3/groups?token=%s' % token
+    url = '%s/groups?token=%s' % (api_url, token)
     json = get_json(url)
     response = json['response']
     
@@ -72,7 +77,7 @@ def get_groups(token):
     
 def get_directs(token):
     """Return a list of direct message chats' IDs and names."""
-    url = 'https://api.groupme.com/v3/chats?token=%s' % token
+    url = '%s/chats?token=%s' % (api_url, token)
     json = get_json(url)
     response = json['response']
     
@@ -103,9 +108,16 @@ def create_history(json, url, self_id, chat_type, chat_ID,
         msg_limit: The number of messages retrieved in a set.
         
     Messages are written down one at a time, each time decrementing 'msg_count'
-    by 1. When this count reaches 0, all messages have been retrieved.
+    by 1. When this count reaches 0, all messages have been retrieved. The
+    time left is estimated by a RuntimeEstimator and shown after every page;
+    the estimator is saved once retrieval finishes.
     """
     f = open(('%s_chat_history.txt' % chat_ID), 'w')
+    estimator = RuntimeEstimator(chat_type, msg_count)
+    total = msg_count
+    fetch_time = None
+    page_start = time.time()
+    page_size = 0
     
     if chat_type == 'group':
         msg = 'messages'
@@ -165,11 +177,20 @@ def create_history(json, url, self_id, chat_type, chat_ID,
             # of messages. If there are no new messages, set the message count
             # to 0 to finish chat retrieval.
             msg_count -= 1
+            page_size += 1
+            if msg_count == 0 or i == msg_limit - 1:
+                estimator.add_page(page_size, fetch_time,
+                                   time.time() - page_start)
+                show_progress(total - msg_count, total, estimator.remaining())
+                page_size = 0
             if msg_count != 0 and i == msg_limit - 1:
                 try:
                     before_id = json['response'][msg][i]['id']
                     new_url = "%s&before_id=%s" % (url, before_id)
+                    fetch_start = time.time()
                     json = get_json(new_url)
+                    fetch_time = time.time() - fetch_start
+                    page_start = time.time()
                 except urllib2.HTTPError, err:
                     if err.code != 304:
                         f.write('<h1>ERROR: %s</h1>' % err.code)
@@ -183,6 +204,8 @@ def create_history(json, url, self_id, chat_type, chat_ID,
             f.write('<tr><td class="date" colspan="3">%s</td></tr>' % old_date)
     
     f.close()
+    estimator.save()
+    print
         
 def format_history(chat_type, chat_ID):
     """Add HTML headers and footers and order messages from earliest to
@@ -349,11 +372,90 @@ def list_chats(token):
     for direct in directs:
         print "".join(data.ljust(col_width) for data in direct)
     
-def get_runtime(msg_count):
+def load_estimates(name=estimates_name):
+    """Return the saved throughput of past retrievals, as a dictionary of
+    {'fetch': seconds, 'render': seconds} per message for each chat type.
+    The GUI application saves its estimates to the same file.
+    """
+    try:
+        f = open(name)
+        estimates = load(f)
+        f.close()
+    except (IOError, ValueError):
+        return {}
+
+    return estimates
+
+class RuntimeEstimator(object):
+    """Estimate the time left of a chat's retrieval as it runs, the same way
+    the GUI application does.
+
+    The time each page of messages takes to fetch and to render is tracked
+    as an exponentially weighted moving average per message, so estimates
+    follow the network as it speeds up or slows down. The averages start
+    from those saved by the last retrieval of the same chat type, and from
+    'default_rate' if there is none.
+    """
+
+    def __init__(self, chat_type, total, name=estimates_name,
+                 weight=estimate_weight):
+        self.chat_type = chat_type
+        self.total = total
+        self.name = name
+        self.weight = weight
+        self.done = 0
+        self.pages = 0
+
+        saved = load_estimates(name).get(chat_type)
+        if saved:
+            self.fetch = saved['fetch']
+            self.render = saved['render']
+        else:
+            self.fetch = 1.0 / default_rate
+            self.render = 0.0
+
+    def add_page(self, size, fetch_time, render_time):
+        """Record a page of 'size' messages that waited 'fetch_time' seconds
+        to be fetched and took 'render_time' seconds to render.
+        'fetch_time' is None for a page fetched before the retrieval began.
+        """
+        if size <= 0:
+            return
+        weight = self.weight
+        if fetch_time is not None:
+            self.fetch += weight * (fetch_time / size - self.fetch)
+        self.render += weight * (render_time / size - self.render)
+        self.done += size
+        self.pages += 1
+
+    def remaining(self):
+        """Return the estimated seconds left of the retrieval."""
+        return max(self.total - self.done, 0) * (self.fetch + self.render)
+
+    def save(self):
+        """Save the averages as the starting point of the next retrieval of
+        the same chat type. Nothing is saved if no page was measured.
+        """
+        if not self.pages:
+            return
+        estimates = load_estimates(self.name)
+        estimates[self.chat_type] = {'fetch': self.fetch,
+                                     'render': self.render}
+        temp = open('%s.tmp' % self.name, 'w')
+        dump(estimates, temp)
+        temp.close()
+
+        # os.rename() cannot replace an existing file on Windows.
+        if os.path.isfile(self.name):
+            os.remove(self.name)
+        os.rename('%s.tmp' % self.name, self.name)
+
+def get_runtime(msg_count, chat_type):
     """Estimate the time to retrieve the chat history based on the
-    number of messages in the selected chat.
+    number of messages in the selected chat and the throughput of past
+    retrievals of its chat type.
     """
-    seconds = msg_count/360  # based on tests; 360 messages ~= 1 second
+    seconds = RuntimeEstimator(chat_type, msg_count).remaining()
     minutes = seconds/60
     seconds = seconds % 60
     
@@ -361,6 +463,14 @@ def get_runtime(msg_count):
         % (minutes, seconds))
 
     print runtime
+
+def show_progress(done, total, seconds_left):
+    """Show how many messages have been retrieved and the time left,
+    overwriting the previous report on the same line.
+    """
+    sys.stdout.write("\r%i of %i messages, %i:%02i left   "
+                     % (done, total, seconds_left // 60, seconds_left % 60))
+    sys.stdout.flush()
         
 def get_chat(token, chat_type, chat_ID):
     """Obtain the requested chat history and store it in a formatted
@@ -386,7 +496,7 @@ def get_chat(token, chat_type, chat_ID):
         
     # Estimate the runtime using the number of messages in the chat.
     msg_count = i_json['response']['count']
-    get_runtime(msg_count)
+    get_runtime(msg_count, chat_type)
         
     # Obtain the user's ID to color the user's name in the chat file.
     self_id = get_self_id(token)
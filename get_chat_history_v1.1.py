@@ -15,31 +15,136 @@ obtained first---Messages are thus written in reverse-chronological
 order, top to bottom. These messages are put into a temporary text
 file before being written in chronological order into an HTML file.
 The temporary text file is then deleted and a CSS file is created
-to format the HTML file for readability.
+to format the HTML file for readability. Messages can also be
+exported from the local archive as JSON Lines or CSV, including their
+IDs, attachments and likes, for reading by other programs. Every
+archived message can be searched from the command line:
+
+    get_chat_history_v1.1.py search "words to find" [--sender NAME]
+
+and chats can be exported without the window, for example from cron,
+with the token in the GROUPME_TOKEN environment variable or a file:
+
+    get_chat_history_v1.1.py export all --format html --format jsonl
+
+Chats already in the archive can be written out again, without
+retrieving them:
+
+    get_chat_history_v1.1.py render all --compress gzip
 """
 import sys
 import os
 import time
+import argparse
+import signal
+import fnmatch
 
 import itertools
+import gzip
+import io
 import re
+import math
+import hashlib
+import mimetypes
 import linecache
+import shutil
+import random
+import sqlite3
+import Queue
+import httplib
+import socket
+import threading
+import csv
+import cProfile
 import urllib2
-from json import load
-
-from PyQt4 import QtGui, QtCore
-    
+import urlparse
+from multiprocessing.pool import ThreadPool
+from operator import itemgetter
+from json import load, dump, dumps
+from json.encoder import encode_basestring_ascii as encode_json
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+api_url = 'https://api.groupme.com/v3'  # or a stand-in such as a mock server.
 message_limit = 100  # cannot be greater than 100.
+pool_size = 4  # idle keep-alive connections kept open per host.
+request_timeout = 60  # seconds before an unanswered request is dropped.
+block_size = 65536  # bytes read at a time when reversing or copying files.
+prefetch_pages = 2  # pages fetched ahead of the page being written.
+export_concurrency = 4  # chats retrieved at once when exporting all chats.
+request_rate = 10.0  # starting API requests/second of the rate limiter.
+max_request_rate = 50.0  # the rate limiter never goes above this.
+max_retries = 5  # retries of a throttled or failed request before giving up.
+backoff_base = 1.0  # seconds; the most waited before the first retry.
+max_backoff = 60.0  # seconds; the most waited before any retry.
+
+# Responses that mean the API is throttling us or failing for the moment.
+retry_codes = (420, 429, 500, 502, 503, 504)
+
+# Errors of a connection reset, timed out or closed partway through a
+# response. A truncated page fails to decode with a ValueError.
+retry_errors = (httplib.HTTPException, socket.error, ValueError)
+
+archive_name = 'chat_history.db'  # local store of every retrieved message.
+search_limit = 100  # most messages a search returns, most recent first.
+marker_width = 100  # characters the hidden update line is padded to.
+checkpoint_interval = 5  # seconds between checkpoints of a retrieval.
+estimates_name = 'runtime_estimates.json'  # throughput of past retrievals.
+estimate_weight = 0.2  # weight of the latest page in runtime estimates.
+default_rate = 360.0  # messages/second assumed before any are measured.
+profile_phases = False  # time each phase of a retrieval; see PhaseTimer.
+profile_name = None  # file cProfile statistics of a retrieval are dumped to.
+metrics_name = None  # file request metrics of a retrieval are written to.
+list_page_size = 100  # chats requested at a time when listing chats.
+cache_ttl = 300  # seconds the user's ID and chat lists are reused for.
+cache_name = None  # file they are also kept in between runs, if any.
+token_variable = 'GROUPME_TOKEN'  # where the export command finds the token.
+download_media = False  # also download attachments and link local copies.
+media_dir = 'media'  # where attachments are stored, named by their contents.
+media_concurrency = 4  # attachments downloaded at once.
+max_redirects = 5  # redirects followed to an attachment's file.
+output_buffer = 1048576  # bytes buffered before history files are written.
+export_formats = ('html',)  # any of 'html', 'volumes', 'jsonl' and 'csv'.
+volume_split = 'month'  # or the number of messages in each volume.
+export_compression = None  # None, 'gzip' or 'zstd'; how files are written.
+gzip_level = 6  # 1 (fastest) to 9 (smallest).
+zstd_level = 3  # 1 (fastest) to 22 (smallest); needs the zstandard package.
+
+# File name suffixes of compressed files.
+compressed_suffixes = {'gzip': '.gz', 'zstd': '.zst'}
+
+# Attachment types with a file to download at their 'url'.
+media_types = ('image', 'linked_image', 'video')
+
+# File name extensions of common attachment types; mimetypes guesses others.
+media_extensions = {'image/jpeg': '.jpeg', 'image/png': '.png',
+                    'image/gif': '.gif', 'video/mp4': '.mp4'}
+
+# Fields kept from each message, in the order they appear in a record.
+message_fields = ('created_at', 'user_id', 'name', 'text', 'id',
+                  'attachments', 'favorited_by')
+
+# The start and end of every chat history HTML file.
+html_header = (
+    '<!DOCTYPE html>\n<html>\n<body>\n'
+    '<head><meta charset="UTF-8">\n'
+    '<link rel="stylesheet" href="styles.css" type="text/css">\n'
+    '</head>\n'
+    '<table>\n')
+html_footer = '</table>\n</body>\n</html>'
 
 def get_URL(token, chat_type, chat_ID, msg_ID):
     """Retrieve the API URL given an access token, chat type & ID, and optional
     message ID.
     """
     if chat_type == 'group':
-        url = 'https://api.groupme.com/v3/groups/%s/messages' % chat_ID
+        url = '%s/groups/%s/messages' % (api_url, chat_ID)
         url += '?token=%s' % token
     elif chat_type == 'direct':
-        url = 'https://api.groupme.com/v3/direct_messages'
+        url = '%s/direct_messages' % api_url
         url += '?other_user_id=%s' % chat_ID
         url += '&token=%s' % token
 
@@ -50,26 +155,714 @@ def get_URL(token, chat_type, chat_ID, msg_ID):
 
     return url
 
-def get_json(url):
+class PhaseTimer(object):
+    """Cumulative seconds, calls and bytes of each phase of retrieval, such
+    as waiting on requests, rendering pages and writing files.
+
+    A phase is timed by taking start() before it and passing the result to
+    add() after it. While the timer is disabled, start() returns None and
+    add() does nothing, so timing costs no more than the two calls. Phases
+    run on several threads at once, so their seconds can add up to more
+    than the time a retrieval took.
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.totals = {}
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Return the start time of a phase, or None while disabled."""
+        if self.enabled:
+            return time.time()
+
+    def add(self, phase, start, size=0):
+        """Add the time since 'start' and 'size' bytes to a phase."""
+        if start is None:
+            return
+        seconds = time.time() - start
+        with self.lock:
+            totals = self.totals.setdefault(phase, [0.0, 0, 0])
+            totals[0] += seconds
+            totals[1] += 1
+            totals[2] += size
+
+    def reset(self):
+        """Forget every phase timed so far."""
+        with self.lock:
+            self.totals = {}
+
+    def report(self, seconds):
+        """Return a table of the phases, longest first, for a retrieval
+        that took 'seconds' in all.
+        """
+        with self.lock:
+            totals = sorted(self.totals.items(), key=lambda item: -item[1][0])
+
+        lines = ['%-16s %10s %8s %14s' % ('phase', 'seconds', 'calls',
+                                          'bytes')]
+        for phase, (phase_seconds, calls, size) in totals:
+            lines.append('%-16s %10.3f %8i %14i'
+                         % (phase, phase_seconds, calls, size))
+        lines.append('%-16s %10.3f' % ('total', seconds))
+
+        return '\n'.join(lines)
+
+phases = PhaseTimer(profile_phases)
+
+# Numeric IDs in API paths, replaced so that requests group by endpoint.
+endpoint_ids = re.compile(r'/\d+(?=/|$)')
+
+class RequestMetrics(object):
+    """Latency histograms, status counts, retries and bytes of every API
+    request, per endpoint, such as '/v3/groups/:id/messages'.
+
+    Latencies are counted in buckets whose bounds grow by 'ratio' from
+    'smallest' seconds, so percentiles are read to within about 9% however
+    many requests are made, in constant memory. Statuses are HTTP codes, or
+    'error' for requests that failed without one, such as a reset
+    connection or a cut-off response.
+    """
+    ratio = 2 ** 0.125
+    smallest = 0.0001  # seconds; the upper bound of the first bucket.
+
+    def __init__(self):
+        self.endpoints = {}
+        self.lock = threading.Lock()
+
+    def get_stats(self, path):
+        """Return the statistics of the endpoint of 'path'. The lock must
+        be held.
+        """
+        endpoint = endpoint_ids.sub('/:id', path)
+        stats = self.endpoints.get(endpoint)
+        if stats is None:
+            stats = {'requests': 0, 'statuses': {}, 'retries': 0,
+                     'bytes': 0, 'buckets': {}}
+            self.endpoints[endpoint] = stats
+
+        return stats
+
+    def record(self, path, status, seconds, size=0):
+        """Record a request to 'path' that took 'seconds' and was
+        answered with 'status' and 'size' bytes.
+        """
+        if seconds > self.smallest:
+            bucket = int(math.ceil(math.log(seconds / self.smallest,
+                                            self.ratio)))
+        else:
+            bucket = 0
+        with self.lock:
+            stats = self.get_stats(path)
+            stats['requests'] += 1
+            stats['bytes'] += size
+            status = str(status)
+            stats['statuses'][status] = stats['statuses'].get(status, 0) + 1
+            stats['buckets'][bucket] = stats['buckets'].get(bucket, 0) + 1
+
+    def retried(self, path):
+        """Record that a request to 'path' is being retried."""
+        with self.lock:
+            self.get_stats(path)['retries'] += 1
+
+    def reset(self):
+        """Forget every request recorded so far."""
+        with self.lock:
+            self.endpoints = {}
+
+    def percentile(self, buckets, fraction):
+        """Return the latency below which 'fraction' of the requests
+        counted in 'buckets' fell, as the upper bound of its bucket.
+        """
+        wanted = fraction * sum(buckets.values())
+        count = 0
+        for bucket in sorted(buckets):
+            count += buckets[bucket]
+            if count >= wanted:
+                return self.smallest * self.ratio ** bucket
+
+        return 0.0
+
+    def summarize(self):
+        """Return the statistics of each endpoint, with the 50th, 95th and
+        99th percentile latencies and the histogram as a list of
+        [upper bound in seconds, requests].
+        """
+        with self.lock:
+            endpoints = dict((endpoint, dict(stats, statuses=dict(
+                stats['statuses']), buckets=dict(stats['buckets'])))
+                             for endpoint, stats in self.endpoints.items())
+
+        summary = {}
+        for endpoint, stats in endpoints.items():
+            buckets = stats.pop('buckets')
+            for name, fraction in (('p50', 0.5), ('p95', 0.95),
+                                   ('p99', 0.99)):
+                stats[name] = self.percentile(buckets, fraction)
+            stats['histogram'] = [[self.smallest * self.ratio ** bucket,
+                                   buckets[bucket]]
+                                  for bucket in sorted(buckets)]
+            summary[endpoint] = stats
+
+        return summary
+
+    def report(self):
+        """Return a table of the requests to each endpoint, with their
+        percentile latencies in milliseconds.
+        """
+        lines = ['%-28s %8s %7s %7s %7s %7s %12s  %s'
+                 % ('endpoint', 'requests', 'retries', 'p50 ms', 'p95 ms',
+                    'p99 ms', 'bytes', 'statuses')]
+        for endpoint, stats in sorted(self.summarize().items()):
+            statuses = ' '.join('%s:%i' % item
+                                for item in sorted(stats['statuses'].items()))
+            lines.append('%-28s %8i %7i %7.1f %7.1f %7.1f %12i  %s'
+                         % (endpoint, stats['requests'], stats['retries'],
+                            stats['p50'] * 1000, stats['p95'] * 1000,
+                            stats['p99'] * 1000, stats['bytes'], statuses))
+
+        return '\n'.join(lines)
+
+    def dump(self, name):
+        """Write the statistics of each endpoint to a JSON file."""
+        f = open(name, 'w')
+        dump(self.summarize(), f, sort_keys=True)
+        f.close()
+
+metrics = RequestMetrics()
+
+def run_profiled(function, *args):
+    """Call 'function' with 'args' and return its result.
+
+    If the phase timer is enabled, print a breakdown of the time each phase
+    took and a report of the API requests made once it returns. If
+    'metrics_name' is set, write the request metrics to that file, and if
+    'profile_name' is set, dump cProfile statistics of the call to that
+    file for reading with pstats. Only the calling thread is profiled; page
+    fetchers and export_all() workers run on others.
+    """
+    if not phases.enabled and not profile_name and not metrics_name:
+        return function(*args)
+
+    phases.reset()
+    metrics.reset()
+    start = time.time()
+    try:
+        if profile_name:
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(function, *args)
+            finally:
+                profile.dump_stats(profile_name)
+        return function(*args)
+    finally:
+        if phases.enabled:
+            print phases.report(time.time() - start)
+            print metrics.report()
+        if metrics_name:
+            metrics.dump(metrics_name)
+
+class CountedResponse(object):
+    """Wrap an HTTP response to count the bytes read from it, which unlike
+    its Content-Length is known for chunked responses too.
+    """
+    def __init__(self, response):
+        self.response = response
+        self.size = 0
+
+    def read(self, amt=None):
+        data = self.response.read(amt)
+        self.size += len(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+class ConnectionPool(object):
+    """Keep-alive HTTP(S) connections shared by every API request.
+
+    Opening a new TCP and TLS connection for each page of messages costs more
+    than the request itself, so finished connections are handed back to the
+    pool and reused by the next request to the same host. At most 'size' idle
+    connections are kept per host; any extra ones are closed.
+
+    Requests are timed as the phase 'name' and recorded in the request
+    metrics by path. A pool serving something other than the API is given
+    its own name, and records its requests under that name instead. The
+    connection each thread has a request in flight on is kept in 'active',
+    so that the request can be broken off with abort().
+    """
+    def __init__(self, size, name='request'):
+        self.size = size
+        self.name = name
+        self.endpoint = None if name == 'request' else name
+        self.idle = {}
+        self.active = {}
+        self.lock = threading.Lock()
+
+    def get_connection(self, scheme, host):
+        """Return an idle connection to the host, or open a new one, and
+        whether it was idle.
+        """
+        with self.lock:
+            idle = self.idle.get((scheme, host))
+            if idle:
+                return idle.pop(), True
+
+        if scheme == 'https':
+            connection = httplib.HTTPSConnection(host,
+                                                 timeout=request_timeout)
+        else:
+            connection = httplib.HTTPConnection(host, timeout=request_timeout)
+        return connection, False
+
+    def release(self, scheme, host, connection):
+        """Return a connection to the pool once its response has been read."""
+        with self.lock:
+            idle = self.idle.setdefault((scheme, host), [])
+            if len(idle) < self.size:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        """Close every idle connection."""
+        with self.lock:
+            for idle in self.idle.values():
+                for connection in idle:
+                    connection.close()
+            self.idle = {}
+
+    def abort(self, thread):
+        """Break off the request a thread has in flight, if any. It fails at
+        once as if the server had closed the connection.
+        """
+        with self.lock:
+            connection = self.active.get(thread)
+        if connection and connection.sock:
+            try:
+                connection.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def request(self, url, handler):
+        """GET a URL and return the result of 'handler(response)'.
+
+        HTTP errors are raised as urllib2.HTTPError so callers handle them
+        the same way as with urllib2.urlopen().
+        """
+        thread = threading.current_thread()
+        try:
+            return self.send(url, handler, thread)
+        finally:
+            with self.lock:
+                self.active.pop(thread, None)
+
+    def send(self, url, handler, thread):
+        """Make a request for request(), on behalf of 'thread'."""
+        parts = urlparse.urlsplit(url)
+        path = parts.path
+        if parts.query:
+            path += '?%s' % parts.query
+
+        # A pooled connection may have been closed by the server while idle.
+        # If so, it is dropped and the request sent again, on another idle
+        # connection or a fresh one. Only a fresh connection failing is
+        # recorded and raised.
+        start = phases.start()
+        begin = time.time()
+        while True:
+            connection, idle = self.get_connection(parts.scheme,
+                                                   parts.netloc)
+            with self.lock:
+                self.active[thread] = connection
+            try:
+                connection.request('GET', path)
+                response = CountedResponse(connection.getresponse())
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                if idle:
+                    begin = time.time()
+                    continue
+                metrics.record(self.endpoint or parts.path, 'error',
+                               time.time() - begin)
+                raise
+            break
+
+        try:
+            if response.status != 200:
+                response.read()
+                raise urllib2.HTTPError(url, response.status, response.reason,
+                                        response.msg, None)
+            result = handler(response)
+            response.read()  # drain unread data so the socket can be reused
+        except urllib2.HTTPError:
+            connection.close()
+            metrics.record(self.endpoint or parts.path, response.status,
+                           time.time() - begin, response.size)
+            raise
+        except:
+            connection.close()
+            metrics.record(self.endpoint or parts.path, 'error',
+                           time.time() - begin, response.size)
+            raise
+        metrics.record(self.endpoint or parts.path, response.status,
+                       time.time() - begin, response.size)
+        phases.add(self.name, start, response.size)
+
+        if response.will_close:
+            connection.close()
+        else:
+            self.release(parts.scheme, parts.netloc, connection)
+
+        return result
+
+pool = ConnectionPool(pool_size)
+media_pool = ConnectionPool(media_concurrency, 'media')
+
+class RateLimiter(object):
+    """Token bucket shared by every API request.
+
+    Each request takes a token. Tokens are added at 'rate' per second, up to
+    'burst' tokens, and a request waits when none are left. The rate adapts
+    to what the API tells us: it is halved whenever a request is throttled
+    or fails, and grows back by 'step' per successful request, up to
+    'max_rate'. It never drops below 'min_rate'.
+    """
+    def __init__(self, rate, max_rate, min_rate=0.5, burst=5, step=0.1):
+        self.rate = rate
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.burst = burst
+        self.step = step
+        self.tokens = burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Wait until a request may be sent."""
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            # Take the token now, even if it is only added later, so that
+            # waiting requests are served in turn.
+            self.tokens -= 1
+            wait = -self.tokens / self.rate
+
+        if wait > 0:
+            time.sleep(wait)
+
+    def succeeded(self):
+        """Raise the rate after a successful request."""
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.step)
+
+    def throttled(self):
+        """Halve the rate after a throttled or failed request."""
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+
+limiter = RateLimiter(request_rate, max_request_rate)
+
+def get_backoff(err, attempt):
+    """Return the seconds to wait before retrying a failed request.
+
+    The wait is drawn at random up to a limit that doubles with each attempt,
+    so that concurrent requests do not all retry at the same moment. A
+    'Retry-After' header from the API is always respected.
+    """
+    backoff = random.uniform(0, min(max_backoff, backoff_base * 2 ** attempt))
+
+    try:
+        backoff = max(backoff, float(err.hdrs.getheader('Retry-After')))
+    except (AttributeError, TypeError, ValueError):
+        pass
+
+    return backoff
+
+def wait_to_retry(url, err, attempt, cancel=None):
+    """Wait as long as get_backoff() says before retrying a failed request.
+    Return False, without waiting any longer, if 'cancel' is set meanwhile.
+    """
+    start = phases.start()
+    backoff = get_backoff(err, attempt)
+    if cancel:
+        cancelled = cancel.wait(backoff)
+    else:
+        time.sleep(backoff)
+        cancelled = False
+    phases.add('backoff', start)
+    if not cancelled:
+        metrics.retried(urlparse.urlsplit(url).path)
+    return not cancelled
+
+def api_request(url, handler, cancel=None):
+    """GET an API URL through the rate limiter and connection pool and return
+    the result of 'handler(response)'.
+
+    Throttled (420, 429) and failed (5xx) requests are retried up to
+    'max_retries' times with backoff. After that, or for any other HTTP
+    error, the urllib2.HTTPError is raised. Requests that fail with one of
+    'retry_errors', such as a reset connection or a truncated response, are
+    retried the same way, and the last error is raised. If 'cancel', a
+    threading.Event, is set during a backoff, the error is raised at once.
+    """
+    for attempt in range(max_retries + 1):
+        start = phases.start()
+        limiter.acquire()
+        phases.add('rate limit', start)
+        try:
+            result = pool.request(url, handler)
+        except urllib2.HTTPError, err:
+            if err.code not in retry_codes:
+                raise
+            limiter.throttled()
+            if (attempt == max_retries or
+                    not wait_to_retry(url, err, attempt, cancel)):
+                raise
+            continue
+        except retry_errors, err:
+            if (attempt == max_retries or
+                    not wait_to_retry(url, err, attempt, cancel)):
+                raise
+            continue
+
+        limiter.succeeded()
+        return result
+
+def get_json(url, cancel=None):
     """Retrieve the JSON response from an API."""
-    response = urllib2.urlopen(url)
-    json = load(response)
+    json = api_request(url, load, cancel)
 
     return json
 
+# Return the kept fields of a decoded message as a tuple.
+get_record = itemgetter(*message_fields)
+
+def read_page(response):
+    """Decode a page of messages and return a list of their records.
+
+    json.load() is implemented in C, which makes decoding the whole page
+    faster than decoding its messages one at a time as they arrive.
+    """
+    json = load(response)['response']
+    if 'messages' in json:
+        messages = json['messages']
+    else:
+        messages = json['direct_messages']
+
+    return [get_record(message) for message in messages]
+
+def get_page(url, cancel=None):
+    """Retrieve a page of messages as a list of records."""
+    page = api_request(url, read_page, cancel)
+
+    return page
+
+class PageFetcher(threading.Thread):
+    """Fetch the remaining pages of a chat on a background thread.
+
+    The ID of a page's last message is the 'before_id' of the next page, so
+    the next page is requested as soon as a page arrives, while earlier pages
+    are still being written. Pages are handed over through a queue holding at
+    most 'size' pages; if the writer falls behind, the fetcher waits.
+
+    Fetching ends after the last page, after a page with fewer than
+    'msg_limit' messages, on an error, or once stopped; a request waiting to
+    be retried is given up when stopped. None is handed over after the last
+    page; an error is handed over in place of the page that raised it.
+    """
+    def __init__(self, url, page, msg_count, msg_limit, size):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.url = url
+        self.page = page
+        self.msg_count = msg_count
+        self.msg_limit = msg_limit
+        self.pages = Queue.Queue(size)
+        self.stopped = threading.Event()
+
+    def run(self):
+        page = self.page
+        msg_count = self.msg_count - len(page)
+
+        while (msg_count > 0 and len(page) == self.msg_limit
+               and not self.stopped.is_set()):
+            new_url = '%s&before_id=%s' % (self.url, page[-1][4])
+            try:
+                page = get_page(new_url, self.stopped)
+            except Exception, err:
+                self.put(err)
+                return
+            self.put(page)
+            msg_count -= len(page)
+
+        self.put(None)
+
+    def put(self, item):
+        """Hand over an item once there is room, unless stopped."""
+        while not self.stopped.is_set():
+            try:
+                self.pages.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                pass
+
+    def get(self, cancel=None):
+        """Return the next page, None, or an error. Return None at once if
+        'cancel', a threading.Event, is set while waiting.
+        """
+        while not (cancel and cancel.is_set()):
+            try:
+                return self.pages.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        return None
+
+    def stop(self):
+        """Stop fetching, e.g. when the writer gives up early, and wait for
+        the fetcher to end, so that no request outlives the retrieval. The
+        request in flight is broken off, so a server that has stopped
+        answering is never waited for.
+        """
+        self.stopped.set()
+        while self.is_alive():
+            pool.abort(self)
+            self.join(0.1)
+
+def replace_file(temp_name, name):
+    """Replace a file with a finished temporary copy of it."""
+    # os.rename() cannot replace an existing file on Windows.
+    if os.path.isfile(name):
+        os.remove(name)
+    os.rename(temp_name, name)
+
+def save_json(value, name, sync=False):
+    """Write a value as JSON to a temporary file that then replaces the
+    file 'name', so the file on disk is never half-written. If 'sync' is
+    set, the new file is made durable before it replaces the old one.
+    """
+    temp = open('%s.tmp' % name, 'w')
+    dump(value, temp)
+    if sync:
+        temp.flush()
+        os.fsync(temp.fileno())
+    temp.close()
+    replace_file('%s.tmp' % name, name)
+
+class AccountCache(object):
+    """Cache of the user's ID and chat lists, so that looking them up again
+    costs no API requests.
+
+    Entries are keyed by a hash of the API address and the token, never the
+    token itself, and expire 'ttl' seconds after they were fetched. If
+    'name' is given, entries are also kept in that JSON file, so they
+    outlive the application. Errors are never cached.
+    """
+    def __init__(self, ttl, name=None):
+        self.ttl = ttl
+        self.name = name
+        self.entries = {}
+        self.lock = threading.Lock()
+        if name:
+            try:
+                f = open(name)
+                self.entries = load(f)
+                f.close()
+            except (IOError, ValueError):
+                pass
+
+    def get_key(self, token, kind):
+        digest = hashlib.sha256('%s %s' % (api_url, token)).hexdigest()
+        return '%s %s' % (digest, kind)
+
+    def get(self, token, kind, fetch):
+        """Return the cached 'kind' of details of the token's account, or
+        fetch them with fetch(token) if there are none or they expired.
+        """
+        key = self.get_key(token, kind)
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry and entry[0] > time.time():
+            return entry[1]
+
+        value = fetch(token)
+        with self.lock:
+            self.entries[key] = [time.time() + self.ttl, value]
+            self.save()
+
+        return value
+
+    def invalidate(self, token=None, kind=None):
+        """Drop the cached details of the token's account, only those of
+        'kind' if given, or of every account if no token is given.
+        """
+        with self.lock:
+            if token is None:
+                self.entries = {}
+            else:
+                prefix = self.get_key(token, kind or '')
+                for key in self.entries.keys():
+                    if key.startswith(prefix):
+                        del self.entries[key]
+            self.save()
+
+    def save(self):
+        """Write the unexpired entries to the cache file, if there is one.
+        The lock must be held.
+        """
+        if not self.name:
+            return
+        now = time.time()
+        entries = dict((key, entry) for key, entry in self.entries.items()
+                       if entry[0] > now)
+        save_json(entries, self.name)
+
+account_cache = AccountCache(cache_ttl, cache_name)
+
 def get_self_id(token):
-    """Obtain a user's ID given their token."""
-    url = "https://api.groupme.com/v3/users/me?token=%s" % token
+    """Obtain a user's ID given their token. The ID is cached."""
+    return account_cache.get(token, 'self_id', request_self_id)
+
+def get_groups(token):
+    """Return a list of group chats' IDs and names. The list is cached."""
+    return account_cache.get(token, 'groups', request_groups)
+
+def get_directs(token):
+    """Return a list of direct message chats' IDs and names. The list is
+    cached.
+    """
+    return account_cache.get(token, 'directs', request_directs)
+
+def request_self_id(token):
+    """Request a user's ID given their token."""
+    url = "%s/users/me?token=%s" % (api_url, token)
     json = get_json(url)
     user_id = json['response']['user_id']
 
     return user_id
 
-def get_groups(token):
-    """Return a list of group chats' IDs and names."""
-    url = 'https://api.groupme.com/v3/groups?token=%s' % token
-    json = get_json(url)
-    response = json['response']
+def request_list(url):
+    """Request every page of a paged list of chats and return the chats.
+    Pages are requested until one comes back empty.
+    """
+    chats = []
+    page = 1
+    while True:
+        json = get_json('%s&per_page=%i&page=%i'
+                        % (url, list_page_size, page))
+        if not json['response']:
+            return chats
+        chats.extend(json['response'])
+        page += 1
+
+def request_groups(token):
+    """Request a list of group chats' IDs and names."""
+    url = '%s/groups?token=%s' % (api_url, token)
+    response = request_list(url)
 
     groups = []
     for i in response:
@@ -79,11 +872,10 @@ def get_groups(token):
 
     return groups
 
-def get_directs(token):
-    """Return a list of direct message chats' IDs and names."""
-    url = 'https://api.groupme.com/v3/chats?token=%s' % token
-    json = get_json(url)
-    response = json['response']
+def request_directs(token):
+    """Request a list of direct message chats' IDs and names."""
+    url = '%s/chats?token=%s' % (api_url, token)
+    response = request_list(url)
 
     directs = []
     for i in response:
@@ -93,8 +885,684 @@ def get_directs(token):
 
     return directs
 
+def open_archive(name=archive_name):
+    """Open the local message archive, creating it if needed.
+
+    The archive is an SQLite database holding every message retrieved, keyed
+    by chat type, chat ID and message ID, so chat histories can be rendered
+    again without any requests to the API. A connection may only be used
+    by the thread that opened it.
+
+    The archive is kept in write-ahead log mode, so searches and renders
+    read it while chats being retrieved write to it.
+    """
+    archive = sqlite3.connect(name, timeout=60)
+    archive.execute('PRAGMA journal_mode=WAL')
+    archive.execute(
+        'CREATE TABLE IF NOT EXISTS messages ('
+        'chat_type TEXT, chat_ID TEXT, id TEXT, created_at INTEGER, '
+        'user_id TEXT, name TEXT, text TEXT, '
+        'attachments TEXT, favorited_by TEXT, '
+        'PRIMARY KEY (chat_type, chat_ID, id))')
+    archive.execute(
+        'CREATE INDEX IF NOT EXISTS messages_by_time '
+        'ON messages (chat_type, chat_ID, created_at)')
+
+    # Archives created before attachments and likes were kept lack their
+    # columns. Messages stored in them have neither.
+    columns = [row[1] for row in
+               archive.execute('PRAGMA table_info(messages)')]
+    for column in ('attachments', 'favorited_by'):
+        if column not in columns:
+            archive.execute('ALTER TABLE messages ADD COLUMN %s TEXT' % column)
+
+    if not has_text_index(archive):
+        create_text_index(archive)
+
+    return archive
+
+def create_text_index(archive):
+    """Add a full-text index of message names and text to the archive, and
+    index any messages it already holds.
+
+    The index is an SQLite FTS4 table: an on-disk inverted index from each
+    term to the messages and offsets it appears at, with delta-encoded
+    posting lists. It holds no copy of the text, which is read from the
+    messages table. store_page() keeps it up to date, so histories
+    retrieved, repaired or updated are indexed as their messages arrive. If
+    SQLite was built without FTS4, the archive is left without an index and
+    cannot be searched.
+    """
+    for tokenizer in ('unicode61', 'simple'):
+        try:
+            archive.execute(
+                'CREATE VIRTUAL TABLE messages_text USING fts4('
+                'content="messages", name, text, tokenize=%s)' % tokenizer)
+            break
+        except sqlite3.OperationalError:
+            pass
+    else:
+        return
+
+    archive.execute(
+        "INSERT INTO messages_text (messages_text) VALUES ('rebuild')")
+    archive.commit()
+
+def has_text_index(archive):
+    """Return whether the archive has a full-text index."""
+    return bool(archive.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'messages_text'").fetchone())
+
+def store_page(archive, chat_type, chat_ID, page):
+    """Store a page of message records in the archive. Messages already
+    stored are replaced. Attachments and likes are stored as JSON.
+
+    The names and text of the messages are added to the text index, if the
+    archive has one, a page at a time; SQLite triggers doing the same were
+    four times slower.
+
+    The page is committed once stored. Chats retrieved at once share the
+    archive, and each holds its write lock only while storing a page.
+    """
+    indexed = has_text_index(archive)
+    for i in range(0, len(page), message_limit):
+        records = page[i:i + message_limit]
+        keys = ('chat_type = ? AND chat_ID = ? AND id IN (%s)'
+                % ', '.join('?' * len(records)))
+        parameters = [chat_type, chat_ID] + [record[4] for record in records]
+
+        # Messages being replaced leave the index first, while their old
+        # text can still be read.
+        if indexed:
+            archive.execute(
+                'DELETE FROM messages_text WHERE docid IN '
+                '(SELECT rowid FROM messages WHERE %s)' % keys, parameters)
+        archive.executemany(
+            'INSERT OR REPLACE INTO messages '
+            '(chat_type, chat_ID, created_at, user_id, name, text, id, '
+            'attachments, favorited_by) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [(chat_type, chat_ID) + record[:5] +
+             (dumps(record[5]), dumps(record[6])) for record in records])
+        if indexed:
+            archive.execute(
+                'INSERT INTO messages_text (docid, name, text) '
+                'SELECT rowid, name, text FROM messages WHERE %s' % keys,
+                parameters)
+    archive.commit()
+
+def search_archive(archive, query, sender=None, since=None, until=None,
+                   chat_ID=None, limit=search_limit):
+    """Search the archive's messages and return the matches, most recent
+    first, as (chat_type, chat_ID, created_at, name, text) tuples.
+
+    Parameters:
+        archive: A connection from open_archive().
+        query: Words that must all appear in a message's name or text.
+            Words may end in '*' to match any word they begin, and
+            "quoted words" must appear together, in order. OR, NOT and
+            column filters such as 'name:Rob' are also understood; see
+            SQLite's full-text query syntax.
+        sender: Only messages from the user with this ID or name.
+        since, until: Only messages sent at or after 'since' and before
+            'until', in seconds since the epoch.
+        chat_ID: Only messages of this chat.
+        limit: The most messages returned.
+
+    Raise sqlite3.OperationalError if the archive has no text index, or if
+    the query cannot be understood.
+    """
+    # Matches are sorted by time first and only the messages returned are
+    # read in full, rather than sorting the text of every match.
+    sql = ('SELECT m.rowid FROM messages_text JOIN messages AS m '
+           'ON m.rowid = messages_text.docid '
+           'WHERE messages_text MATCH ?')
+    parameters = [query]
+    if sender:
+        sql += ' AND (m.user_id = ? OR m.name = ? COLLATE NOCASE)'
+        parameters += [sender, sender]
+    if since is not None:
+        sql += ' AND m.created_at >= ?'
+        parameters.append(since)
+    if until is not None:
+        sql += ' AND m.created_at < ?'
+        parameters.append(until)
+    if chat_ID:
+        sql += ' AND m.chat_ID = ?'
+        parameters.append(str(chat_ID))
+    sql += ' ORDER BY m.created_at DESC LIMIT ?'
+    parameters.append(limit)
+
+    return archive.execute(
+        'SELECT chat_type, chat_ID, created_at, name, text FROM messages '
+        'WHERE rowid IN (%s) ORDER BY created_at DESC' % sql,
+        parameters).fetchall()
+
+class LocalClock(object):
+    """Format the local dates and hours of message times.
+
+    Calling time.localtime() and time.strftime() for every message is slow.
+    The clock instead remembers a window of time -- normally a whole local
+    day -- in which the UTC offset does not change, and works out the hour
+    of any time in the window by arithmetic. time.localtime() is then called
+    about once per day of messages. Days are numbered, so that day changes
+    are found by comparing integers rather than formatted dates.
+    """
+    def __init__(self):
+        self.start = 0
+        self.end = 0  # no window yet
+        self.offset = 0
+        self.day = None
+        self.date = None
+
+    def set_window(self, epoch_time):
+        """Find the window of time around 'epoch_time'."""
+        local = time.localtime(epoch_time)
+        self.day = local.tm_year * 1000 + local.tm_yday
+        self.date = time.strftime('%A, %d %B %Y', local)
+        seconds = local.tm_hour * 3600 + local.tm_min * 60 + local.tm_sec
+
+        # The whole day, if the UTC offset does not change during it...
+        start = epoch_time - seconds
+        if (time.localtime(start)[2:6] == (local.tm_mday, 0, 0, 0) and
+                time.localtime(start + 86399)[2:6] ==
+                (local.tm_mday, 23, 59, 59)):
+            self.start, self.end, self.offset = start, start + 86400, 0
+            return
+
+        # ...otherwise the hour, if the change is not during it...
+        start = epoch_time - local.tm_min * 60 - local.tm_sec
+        if (time.localtime(start)[3:6] == (local.tm_hour, 0, 0) and
+                time.localtime(start + 3599)[3:6] ==
+                (local.tm_hour, 59, 59)):
+            self.start, self.end = start, start + 3600
+            self.offset = local.tm_hour * 3600
+            return
+
+        # ...otherwise only this second.
+        self.start, self.end, self.offset = epoch_time, epoch_time + 1, seconds
+
+    def format(self, epoch_time):
+        """Return the day number, date, and hour of a message time."""
+        if not self.start <= epoch_time < self.end:
+            self.set_window(epoch_time)
+
+        seconds = epoch_time - self.start + self.offset
+        hour = '%02d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60,
+                                   seconds % 60)
+
+        return self.day, self.date, hour
+
+class MediaStore(object):
+    """Download attachments in the background into a content-addressed
+    store shared by every chat.
+
+    Each file is named by the SHA-256 of its contents, so an image posted
+    again in any chat is stored once. URLs are queued with add() as pages
+    are rendered and downloaded by 'concurrency' threads, so the text of a
+    chat is never held up by its attachments. HTML files are written with
+    links to the original URLs and passed to relink(), which points them
+    at the downloaded copies in the background once the downloads finish.
+    Which file each URL was stored as is kept in index.json in the store,
+    so nothing is downloaded twice. Failed downloads, and files that could
+    not be relinked, are kept in 'failed'; their links are left as they are.
+    """
+    def __init__(self, directory=media_dir, concurrency=media_concurrency):
+        self.directory = directory
+        self.concurrency = concurrency
+        self.index_name = os.path.join(directory, 'index.json')
+        try:
+            f = open(self.index_name)
+            self.paths = load(f)
+            f.close()
+        except (IOError, ValueError):
+            self.paths = {}
+        self.queued = set()
+        self.failed = {}
+        self.queue = Queue.Queue()
+        self.threads = []
+        self.relinks = []
+        self.relinker = None
+        self.lock = threading.Lock()
+
+    def add(self, url):
+        """Queue a URL to be downloaded, unless it already has been."""
+        with self.lock:
+            if url in self.paths or url in self.queued:
+                return
+            self.queued.add(url)
+            if not self.threads:
+                if not os.path.isdir(self.directory):
+                    os.makedirs(self.directory)
+                for i in range(self.concurrency):
+                    thread = threading.Thread(target=self.run)
+                    thread.daemon = True
+                    thread.start()
+                    self.threads.append(thread)
+        self.queue.put(url)
+
+    def format_links(self, attachments):
+        """Queue the files of a message's attachments and return HTML links
+        to them, to follow its text.
+        """
+        links = []
+        for attachment in attachments:
+            url = attachment.get('url')
+            if attachment.get('type') in media_types and url:
+                self.add(url)
+                links.append(u' <a class="attachment" href="%s">[%s]</a>'
+                             % (escape_html(url), attachment['type']))
+
+        return u''.join(links)
+
+    def run(self):
+        while True:
+            url = self.queue.get()
+            if url is None:
+                self.queue.task_done()
+                return
+            try:
+                path = self.download(url)
+                with self.lock:
+                    self.paths[url] = path
+            except Exception, err:
+                with self.lock:
+                    self.failed[url] = err
+            self.queue.task_done()
+
+    def download(self, url):
+        """Download a URL into the store and return its path there.
+
+        Files are fetched on keep-alive connections from 'media_pool',
+        following up to 'max_redirects' redirects. A file shorter than its
+        Content-Length was cut off and raises IOError; nothing is kept of a
+        failed download.
+        """
+        temp_name = os.path.join(self.directory, '%s.tmp'
+                                 % threading.current_thread().ident)
+
+        def save(response):
+            # Hash the file as it is written, then name it by its hash.
+            digest = hashlib.sha256()
+            size = 0
+            temp = open(temp_name, 'wb')
+            try:
+                while True:
+                    data = response.read(block_size)
+                    if not data:
+                        break
+                    digest.update(data)
+                    temp.write(data)
+                    size += len(data)
+            finally:
+                temp.close()
+
+            # httplib returns what it has when a response ends early.
+            length = response.getheader('content-length')
+            if length and size != int(length):
+                raise IOError('%s was cut off after %i of %s bytes'
+                              % (url, size, length))
+            return digest.hexdigest(), response.getheader('content-type', '')
+
+        try:
+            for redirect in range(max_redirects + 1):
+                try:
+                    digest, content_type = media_pool.request(url, save)
+                    break
+                except urllib2.HTTPError, err:
+                    location = err.hdrs.getheader('location')
+                    if (err.code not in (301, 302, 303, 307, 308) or
+                            not location or redirect == max_redirects):
+                        raise
+                    url = urlparse.urljoin(url, location)
+        except:
+            if os.path.isfile(temp_name):
+                os.remove(temp_name)
+            raise
+
+        content_type = content_type.split(';')[0].strip()
+        extension = (media_extensions.get(content_type) or
+                     mimetypes.guess_extension(content_type) or
+                     os.path.splitext(urlparse.urlsplit(url).path)[1])
+
+        path = '%s/%s%s' % (digest[:2], digest, extension)
+        name = os.path.join(self.directory, *path.split('/'))
+        if os.path.isfile(name):
+            os.remove(temp_name)
+        else:
+            if not os.path.isdir(os.path.dirname(name)):
+                os.makedirs(os.path.dirname(name))
+            os.rename(temp_name, name)
+
+        return path
+
+    def link_local(self, line, prefix=''):
+        """Return a rendered line with its attachment links pointing to the
+        downloaded copies, as seen from a file 'prefix' away from the
+        directory holding the store, e.g. '../'.
+        """
+        if 'class="attachment"' not in line:
+            return line
+
+        def link(match):
+            url = match.group(1).replace('&quot;', '"').replace('&gt;', '>')
+            url = url.replace('&lt;', '<').replace('&amp;', '&')
+            path = self.paths.get(url.decode('UTF-8'))
+            if not path:
+                return match.group(0)
+            return 'class="attachment" href="%s%s/%s"' % (
+                prefix, self.directory, path)
+
+        return attachment_link.sub(link, line)
+
+    def relink(self, name, prefix=''):
+        """Point the attachment links of a written HTML file at the
+        downloaded copies, as in link_local(), once every URL queued so far
+        is downloaded. The file is rewritten in the background.
+        """
+        with self.lock:
+            self.relinks.append((name, prefix))
+            if not self.relinker:
+                self.relinker = threading.Thread(target=self.run_relinks)
+                self.relinker.daemon = True
+                self.relinker.start()
+
+    def run_relinks(self):
+        while True:
+            self.wait()
+            with self.lock:
+                relinks, self.relinks = self.relinks, []
+                if not relinks:
+                    self.relinker = None
+                    return
+            for name, prefix in relinks:
+                try:
+                    self.link_file(name, prefix)
+                except (IOError, OSError), err:
+                    with self.lock:
+                        self.failed[name] = err
+
+    def link_file(self, name, prefix=''):
+        """Rewrite an HTML file with its attachment links pointing to the
+        downloaded copies. A compressed file keeps its compression.
+        """
+        root, suffix = os.path.splitext(name)
+        temp_name = '%s.tmp%s' % (root, suffix)
+        f = open_history(name)
+        copy = open_history(temp_name, 'wb')
+        for line in f:
+            copy.write(self.link_local(line, prefix))
+        f.close()
+        copy.close()
+        replace_file(temp_name, name)
+
+    def wait(self):
+        """Wait until every URL queued so far is downloaded or failed."""
+        self.queue.join()
+
+    def close(self):
+        """Wait for the downloads and relinking, stop the threads and save
+        the index.
+        """
+        self.wait()
+        while True:
+            with self.lock:
+                relinker = self.relinker
+            if not relinker:
+                break
+            relinker.join()
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        media_pool.close()
+        if not self.paths:
+            return
+
+        with self.lock:
+            save_json(self.paths, self.index_name)
+
+# The start of an attachment link in a rendered line, and its URL.
+attachment_link = re.compile(r'class="attachment" href="([^"]*)"')
+
+# HTML table rows of the user's messages and everyone else's.
+self_row = ('<tr><td class="self_name">%s</td> '
+            '<td class="self_hour">(%s):</td> '
+            '<td class="text">%s</td></tr>\n')
+other_row = ('<tr><td class="name">%s</td> '
+             '<td class="hour">(%s):</td> '
+             '<td class="text">%s</td></tr>\n')
+date_row = '<tr><td class="date" colspan="3">%s</td></tr>\n'
+
+# Replacements that make message text safe to write into HTML, in order.
+html_escapes = ((u'&', u'&amp;'), (u'<', u'&lt;'), (u'>', u'&gt;'),
+                (u'"', u'&quot;'), (u'\r\n', u'<br>'), (u'\n', u'<br>'),
+                (u'\r', u'<br>'))
+html_special = re.compile(u'[&<>"\r\n]')
+
+def escape_html(text):
+    """Return text escaped for HTML, with its line breaks as <br>.
+
+    Most messages hold none of the characters replaced; those are found with
+    a single regular expression search and returned as they are.
+    """
+    if not html_special.search(text):
+        return text
+    for old, new in html_escapes:
+        if old in text:
+            text = text.replace(old, new)
+
+    return text
+
+def format_row(hour, user_id, name, text, self_id, links=u''):
+    """Return the HTML table row of a message, not yet encoded. 'links' is
+    HTML added after the text, such as links to attachments.
+    """
+    name = escape_html(name)
+    text = escape_html(text) if text else u''
+    if links:
+        text += links
+
+    # Format into HTML.
+    if user_id == self_id:
+        return self_row % (name, hour, text)
+    return other_row % (name, hour, text)
+
+def format_message(hour, user_id, name, text, self_id):
+    """Return the UTF-8 encoded HTML table row of a message."""
+    row = format_row(hour, user_id, name, text, self_id)
+
+    return row.encode('UTF-8', 'replace')
+
+def render_page(page, self_id, clock, old_day, old_date, media=None):
+    """Render a page of message records, most recent first, for a temporary
+    chat history file.
+
+    As in create_history(), the date of a day's messages is written after
+    them, when the day changes. Rows are formatted as unicode and encoded
+    once per day of messages, and the page is returned as a single string
+    to be written at once. If a MediaStore is given as 'media', the files
+    of any attachments are queued with it and linked after the text.
+
+    Returns the rendered page and the day number and date of its last
+    message.
+    """
+    chunks = []
+    rows = []
+    for epoch_time, user_id, name, text, msg_id, attachments, likes in page:
+        day, date, hour = clock.format(epoch_time)
+
+        # Separate messages by date.
+        if day != old_day:
+            if rows:
+                chunks.append(u''.join(rows).encode('UTF-8', 'replace'))
+                rows = []
+            chunks.append(date_row % old_date)
+            old_day = day
+            old_date = date
+
+        if media and attachments:
+            rows.append(format_row(hour, user_id, name, text, self_id,
+                                   media.format_links(attachments)))
+        else:
+            rows.append(format_row(hour, user_id, name, text, self_id))
+
+    if rows:
+        chunks.append(u''.join(rows).encode('UTF-8', 'replace'))
+
+    return ''.join(chunks), old_day, old_date
+
+def format_update_details(chat_type, chat_ID, after_id, date,
+                          width=marker_width):
+    """Return the hidden line recording the most recent message of a chat
+    history file. The line is padded with spaces to 'width' characters so
+    that update_chat() can later overwrite it in place.
+    """
+    details = '%s %s %s %s' % (chat_type, chat_ID, after_id, date)
+    details = details.ljust(width - len('<p hidden update></p>'))
+
+    return '<p hidden update>%s</p>\n' % details
+
+def get_checkpoint_name(chat_ID, msg_ID):
+    """Return the name of the checkpoint file of a chat's retrieval."""
+    if msg_ID:
+        return '%s_chat_history_repair.checkpoint' % chat_ID
+    return '%s_chat_history.checkpoint' % chat_ID
+
+def read_checkpoint(chat_type, chat_ID, msg_ID, render=True):
+    """Return the last checkpoint of an interrupted retrieval of a chat, or
+    None if there is none to resume from. If 'render' is set, a retrieval
+    that wrote no rows cannot be resumed. A repair is only resumed by a
+    repair from the same message, since repairs of a chat share one
+    checkpoint file.
+    """
+    if msg_ID:
+        temp_name = '%s_chat_history_repair.txt' % chat_ID
+    else:
+        temp_name = '%s_chat_history.txt' % chat_ID
+
+    try:
+        f = open(get_checkpoint_name(chat_ID, msg_ID))
+        checkpoint = load(f)
+        f.close()
+    except (IOError, ValueError):
+        return None
+
+    if (checkpoint['chat_type'] != chat_type or
+            checkpoint['msg_ID'] != msg_ID or
+            render and not checkpoint.get('render', True) or
+            not os.path.isfile(temp_name) or
+            os.path.getsize(temp_name) < checkpoint['size']):
+        return None
+
+    return checkpoint
+
+def write_checkpoint(f, archive, checkpoint):
+    """Make everything written so far durable, then record a checkpoint.
+
+    The checkpoint is written to a temporary file that then replaces the
+    previous checkpoint, so the checkpoint on disk is never half-written.
+    """
+    f.flush()
+    os.fsync(f.fileno())
+    if archive:
+        archive.commit()
+
+    name = get_checkpoint_name(checkpoint['chat_ID'], checkpoint['msg_ID'])
+    save_json(checkpoint, name, sync=True)
+
+def format_repair_details(chat_type, chat_ID, before_id, date, code, msg):
+    """Return the hidden repair line and error details written where a
+    retrieval stopped early. A repair continues from 'before_id'.
+    """
+    return ('<p hidden repair>%s %s %s %s</p>\n'
+            '<h1>ERROR: %s</h1><h1>msg: %s</h1><h1>chat_type: %s</h1>'
+            '<h1>chat_ID: %s</h1><h1>latest_message_id: %s</h1>\n'
+            % (chat_type, chat_ID, before_id, date, code, msg, chat_type,
+               chat_ID, before_id))
+
+estimates_lock = threading.Lock()
+
+def load_estimates(name=estimates_name):
+    """Return the saved throughput of past retrievals, as a dictionary of
+    {'fetch': seconds, 'render': seconds} per message for each chat type.
+    """
+    try:
+        f = open(name)
+        estimates = load(f)
+        f.close()
+    except (IOError, ValueError):
+        return {}
+
+    return estimates
+
+class RuntimeEstimator(object):
+    """Estimate the time left of a chat's retrieval as it runs.
+
+    The time each page of messages takes to fetch and to render is tracked
+    as an exponentially weighted moving average per message, so estimates
+    follow the network as it speeds up or slows down. The averages start
+    from those saved by the last retrieval of the same chat type, and from
+    'default_rate' if there is none.
+    """
+
+    def __init__(self, chat_type, total, name=estimates_name,
+                 weight=estimate_weight):
+        self.chat_type = chat_type
+        self.total = total
+        self.name = name
+        self.weight = weight
+        self.done = 0
+        self.pages = 0
+
+        saved = load_estimates(name).get(chat_type)
+        if saved:
+            self.fetch = saved['fetch']
+            self.render = saved['render']
+        else:
+            self.fetch = 1.0 / default_rate
+            self.render = 0.0
+
+    def add_page(self, size, fetch_time, render_time):
+        """Record a page of 'size' messages that waited 'fetch_time' seconds
+        to be fetched and took 'render_time' seconds to store and render.
+        'fetch_time' is None for a page fetched before the retrieval began.
+        """
+        if size <= 0:
+            return
+        weight = self.weight
+        if fetch_time is not None:
+            self.fetch += weight * (fetch_time / size - self.fetch)
+        self.render += weight * (render_time / size - self.render)
+        self.done += size
+        self.pages += 1
+
+    def rate(self):
+        """Return the estimated messages retrieved per second."""
+        seconds = self.fetch + self.render
+        return 1.0 / seconds if seconds > 0 else default_rate
+
+    def remaining(self):
+        """Return the estimated seconds left of the retrieval."""
+        return max(self.total - self.done, 0) * (self.fetch + self.render)
+
+    def save(self):
+        """Save the averages as the starting point of the next retrieval of
+        the same chat type. Nothing is saved if no page was measured.
+        """
+        if not self.pages:
+            return
+        with estimates_lock:
+            estimates = load_estimates(self.name)
+            estimates[self.chat_type] = {'fetch': self.fetch,
+                                         'render': self.render}
+            save_json(estimates, self.name)
+
 def create_history(json, url, self_id, chat_type, chat_ID,
-                   msg_count, msg_limit, msg_ID):
+                   msg_count, msg_limit, msg_ID, archive=None,
+                   checkpoint=None, progress=None, cancel=None, media=None,
+                   render=True):
     """Create a temporary chat history file.
 
     Retrieve and write down all dates, times, names, and messages in a
@@ -112,131 +1580,336 @@ def create_history(json, url, self_id, chat_type, chat_ID,
         msg_limit: The number of messages retrieved in a set.
         msg_ID: Message ID needed to retrieve all earlier chat messages.
             Currently used only for repairing chat histories.
+        archive: Optional connection from open_archive(). Every message
+            written down is also stored in it.
+        checkpoint: Optional checkpoint from read_checkpoint() to resume an
+            interrupted retrieval from. 'json' is then the set of messages
+            before the checkpoint's message ID.
+        progress: Optional function called as progress(done, total,
+            seconds_left) with the number of messages written so far and
+            the estimated seconds left, before the first page and after
+            every page.
+        cancel: Optional threading.Event. Once it is set, retrieval stops
+            after the current page, or at once while waiting for the next
+            one, and the file is finished with a repair marker, as after an
+            HTTPError, so it can be repaired later.
+        media: Optional MediaStore. Attachments are downloaded into it in
+            the background and linked by render_page().
+        render: If false, messages are only stored in the archive, and no
+            rows are written; the file holds only the update and repair
+            details.
         
     Messages are written down one at a time, each time decrementing 'msg_count'
-    by 1. When this count reaches 0, all messages have been retrieved.
+    by 1. When this count reaches 0, all messages have been retrieved. Pages
+    after the first are read with get_page() as lists of records by a
+    PageFetcher, which fetches ahead while earlier pages are being written.
+
+    Every 'checkpoint_interval' seconds, the file is made durable and a
+    checkpoint of the retrieval is written. If retrieval is interrupted in
+    any way, it can be resumed from the last checkpoint with little work
+    lost. The checkpoint is removed once retrieval finishes.
+
+    The time left is estimated by a RuntimeEstimator, which is saved once
+    retrieval finishes so that the next retrieval starts from it.
+
+    Returns None once every message is written, or the error code recorded
+    in the repair marker ('cancelled' if cancelled) if retrieval stopped
+    early.
     """
     if chat_type == 'group':
         msg = 'messages'
     elif chat_type == 'direct':
         msg = 'direct_messages'
+    page = [get_record(message) for message in json['response'][msg]]
         
     if msg_ID:
-        f = open(('%s_chat_history_repair.txt' % chat_ID), 'w')
+        temp_name = '%s_chat_history_repair.txt' % chat_ID
     else:
-        f = open(('%s_chat_history.txt' % chat_ID), 'w')
-    
-    # Get the date of the most recent message. This date is needed as a
-    # starting point to tell when the date next changes.
-    initial_time = json['response'][msg][0]['created_at']
-    old_date = time.strftime('%A, %d %B %Y', time.localtime(initial_time))
-    
-    # Record details of most recent message. Will be needed for updating chat
-    # histories.
-    after_id = json['response'][msg][0]['id']
-    update_details = ('<p hidden update>%s %s %s %s</p>\n' 
-                      % (chat_type, chat_ID, after_id, old_date))
+        temp_name = '%s_chat_history.txt' % chat_ID
+
+    clock = LocalClock()
+    if checkpoint:
+        # Continue from the checkpoint, dropping anything written after it.
+        f = open(temp_name, 'r+b', output_buffer)
+        f.seek(checkpoint['size'])
+        f.truncate()
+        old_day = checkpoint['day']
+        old_date = checkpoint['date']
+        update_details = checkpoint['update_details']
+        msg_count = checkpoint['msg_count']
+    else:
+        f = open(temp_name, 'wb', output_buffer)
+
+        # Get the date of the most recent message. This date is needed as a
+        # starting point to tell when the date next changes.
+        initial_time = page[0][0]
+        old_day, old_date, hour = clock.format(initial_time)
+
+        # Record details of most recent message. Will be needed for updating
+        # chat histories.
+        after_id = page[0][4]
+        update_details = format_update_details(chat_type, chat_ID, after_id,
+                                               old_date)
+    checkpoint_time = time.time()
+    total = msg_count
+    estimator = RuntimeEstimator(chat_type, total)
+    fetch_time = None
+    stopped = None
+    if progress:
+        progress(0, total, estimator.remaining())
     
-    while msg_count > 0:
-        # If there are less than 'msg_limit' messages to obtain, only
-        # iterate through however many messages there are.
-        if msg_count < msg_limit:
-            msg_limit = msg_count % msg_limit
-            
-        for i in range(msg_limit):
-            # Parse the data and retrieve times, names, and messages.
-            # If the final number of messages is less than expected, set the
-            # message count to 0 since all messages will have been retrieved.
-            try:
-                epoch_time = json['response'][msg][i]['created_at']
-            except IndexError:
+    # Pages after the first are fetched in the background while earlier
+    # pages are written.
+    fetcher = PageFetcher(url, page, msg_count, msg_limit, prefetch_pages)
+    fetcher.start()
+
+    try:
+        while msg_count > 0:
+            # If there are less than 'msg_limit' messages to obtain, only
+            # iterate through however many messages there are.
+            page = page[:msg_count]
+            render_start = time.time()
+            if archive:
+                start = phases.start()
+                store_page(archive, chat_type, chat_ID, page)
+                phases.add('archive', start)
+
+            # Write down dates, times, names, and messages, a page at a time.
+            if render:
+                start = phases.start()
+                data, old_day, old_date = render_page(page, self_id, clock,
+                                                      old_day, old_date,
+                                                      media)
+                phases.add('render', start, len(data))
+                start = phases.start()
+                f.write(data)
+                phases.add('write', start, len(data))
+            estimator.add_page(len(page), fetch_time,
+                               time.time() - render_start)
+            msg_count -= len(page)
+            if page:
+                msg_id = page[-1][4]
+            if progress:
+                progress(total - max(msg_count, 0), total,
+                         estimator.remaining())
+
+            if msg_count > 0 and (time.time() - checkpoint_time
+                                  >= checkpoint_interval):
+                start = phases.start()
+                write_checkpoint(f, archive, {
+                    'chat_type': chat_type, 'chat_ID': chat_ID,
+                    'msg_ID': msg_ID, 'before_id': msg_id,
+                    'size': f.tell(), 'day': old_day, 'date': old_date,
+                    'update_details': update_details,
+                    'msg_count': msg_count, 'render': render})
+                phases.add('checkpoint', start)
+                checkpoint_time = time.time()
+
+            # Take the next set of messages from the fetcher. If there are no
+            # new messages, set the message count to 0 to finish chat
+            # retrieval. Record HTTPErrors and cancellation, which is checked
+            # while waiting; the latest message ID written is where a repair
+            # continues from.
+            if msg_count > 0:
+                fetch_start = time.time()
+                page = fetcher.get(cancel)
+                fetch_time = time.time() - fetch_start
+                if phases.enabled:
+                    phases.add('page wait', fetch_start)
+            if msg_count > 0 and cancel and cancel.is_set():
+                f.write(format_repair_details(chat_type, chat_ID, msg_id,
+                                              old_date, 'cancelled',
+                                              'Retrieval was cancelled'))
+                stopped = 'cancelled'
                 msg_count = 0
-                break
-            date = time.strftime('%A, %d %B %Y', time.localtime(epoch_time))
-
-            user_id = json['response'][msg][i]['user_id']
-            name = json['response'][msg][i]['name']
-            hour = time.strftime('%H:%M:%S', time.localtime(epoch_time))
-            text = json['response'][msg][i]['text']
-            if text: text = text.encode('unicode-escape')  # escape \n, etc.
-
-            # Format into HTML.
-            if user_id == self_id:
-                name = '<td class="self_name">%s</td>' % name
-                hour = '<td class="self_hour">(%s):</td>' % hour
-            else:
-                name = '<td class="name">%s</td>' % name
-                hour = '<td class="hour">(%s):</td>' % hour
-            text = '<td class="text">%s</td>' % text
-            line = '<tr>%s %s %s</tr>\n' % (name, hour, text)
-
-            # Separate messages by date.
-            if date != old_date:
-                f.write('<tr>')
-                f.write('<td class="date" colspan="3">%s</td>' % old_date)
-                f.write('</tr>\n')
-                old_date = date
-
-            # Write down times, names, and messages.
-            f.write(line.encode('UTF-8', 'replace'))
-
-            # Once we have reached the 'msg_limit', store the latest message ID
-            # and use it to obtain the API URL and JSON file for the next set
-            # of messages. If there are no new messages, set the message count
-            # to 0 to finish chat retrieval. Record HTTPErrors.
-            msg_count -= 1
-            if msg_count != 0 and i == msg_limit - 1:
-                try:
-                    before_id = json['response'][msg][i]['id']
-                    new_url = '%s&before_id=%s' % (url, before_id)
-                    json = get_json(new_url)
-                except urllib2.HTTPError, err:
+            elif msg_count > 0:
+                if page is None:
+                    msg_count = 0
+                elif isinstance(page, urllib2.HTTPError):
+                    err = page
                     if err.code != 304:
-                        f.write('<p hidden repair>%s %s %s %s</p>\n' 
-                                % (chat_type, chat_ID, before_id, old_date))
-                        f.write('<h1>ERROR: %s</h1>' % err.code)
-                        f.write('<h1>msg: %s</h1>' % err.msg)
-                        f.write('<h1>chat_type: %s</h1>' % chat_type)
-                        f.write('<h1>chat_ID: %s</h1>' % chat_ID)
-                        f.write('<h1>latest_message_id: %s</h1>\n' % before_id)
+                        f.write(format_repair_details(chat_type, chat_ID,
+                                                      msg_id, old_date,
+                                                      err.code, err.msg))
+                        stopped = err.code
                     msg_count = 0
-
-        if msg_count == 0:
-            f.write(update_details)
-            # Finally, write the group creation date.
-            f.write('<tr><td class="date" colspan="3">%s</td></tr>\n' % old_date)
+                elif isinstance(page, Exception):
+                    raise page
+
+            if msg_count == 0:
+                f.write(update_details)
+                # Finally, write the group creation date.
+                f.write(date_row % old_date)
+    finally:
+        fetcher.stop()
+        estimator.save()
     
     f.close()
+    if os.path.isfile(get_checkpoint_name(chat_ID, msg_ID)):
+        os.remove(get_checkpoint_name(chat_ID, msg_ID))
+
+    return stopped
 
-def format_history(chat_type, chat_ID, msg_ID):
+class ZstdFile(object):
+    """A zstd-compressed file, opened either for reading or for writing.
+
+    Data is compressed or decompressed as it streams through, one block at a
+    time. Only the file methods that chat history files are used through
+    are provided.
+    """
+    def __init__(self, name, mode='rb'):
+        self.file = open(name, mode.replace('b', '') + 'b', output_buffer)
+        if 'w' in mode:
+            compressor = zstandard.ZstdCompressor(level=zstd_level)
+            self.compressor = compressor.compressobj()
+        else:
+            decompressor = zstandard.ZstdDecompressor()
+            self.reader = decompressor.stream_reader(self.file)
+        self.buf = ''
+        self.pos = 0
+
+    def fill(self):
+        """Decompress up to 'block_size' more bytes into the buffer, dropping
+        what has already been read. Return False at the end of the file.
+        """
+        block = self.reader.read(block_size)
+        if not block:
+            return False
+        self.buf = self.buf[self.pos:] + block
+        self.pos = 0
+        return True
+
+    def read(self, size=-1):
+        if size < 0:
+            chunks = [self.buf[self.pos:]]
+            chunks.extend(iter(lambda: self.reader.read(block_size), ''))
+            self.buf = ''
+            self.pos = 0
+            return ''.join(chunks)
+
+        while len(self.buf) - self.pos < size and self.fill():
+            pass
+        data = self.buf[self.pos:self.pos + size]
+        self.pos += len(data)
+        return data
+
+    def readline(self):
+        end = self.buf.find('\n', self.pos)
+        while end == -1 and self.fill():
+            end = self.buf.find('\n', self.pos)
+        if end == -1:
+            return self.read(len(self.buf) - self.pos)
+        return self.read(end + 1 - self.pos)
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def write(self, data):
+        self.file.write(self.compressor.compress(data))
+
+    def close(self):
+        if hasattr(self, 'compressor'):
+            self.file.write(self.compressor.flush())
+        self.file.close()
+
+def get_compression(name):
+    """Return how a file is compressed, going by its name: None, 'gzip' or
+    'zstd'.
+    """
+    for kind, suffix in compressed_suffixes.items():
+        if name.endswith(suffix):
+            return kind
+    return None
+
+def open_history(name, mode='rb'):
+    """Open a chat history or export file, compressing or decompressing it
+    as it is written or read if its name ends in a compressed suffix. Raise
+    IOError for a zstd file if the zstandard package is not installed.
+    """
+    kind = get_compression(name)
+    if kind == 'gzip':
+        f = gzip.GzipFile(name, mode, gzip_level)
+        if 'w' in mode:
+            # Every write to a GzipFile is compressed on its own, so small
+            # writes are gathered first.
+            f = io.BufferedWriter(f, output_buffer)
+        return f
+    elif kind == 'zstd':
+        if not zstandard:
+            raise IOError('The zstandard package is needed to open %s' % name)
+        return ZstdFile(name, mode)
+    return open(name, mode, output_buffer)
+
+def reverse_lines(f):
+    """Yield the lines of a file opened in binary mode, last line first.
+
+    The file is read backwards one block at a time with seek(), so at most
+    one block and one line are held in memory however large the file is.
+    """
+    f.seek(0, os.SEEK_END)
+    pos = f.tell()
+
+    buf = ''
+    while pos > 0:
+        size = min(block_size, pos)
+        pos -= size
+        f.seek(pos)
+        buf = f.read(size) + buf
+
+        # Yield every line that is complete, from the end of the buffer. The
+        # text before the first line break may continue in an earlier block.
+        end = len(buf)
+        start = buf.rfind('\n', 0, end - 1)
+        while start != -1:
+            yield buf[start + 1:end]
+            end = start + 1
+            start = buf.rfind('\n', 0, end - 1)
+        buf = buf[:end]
+
+    if buf:
+        yield buf
+
+def format_history(chat_type, chat_ID, msg_ID, compression=None,
+                   media=None):
     """Add HTML headers and footers and order messages from earliest to
     most recent, top to bottom. Reference the HTML file to a CSS file.
+
+    The HTML file is compressed as it is written if 'compression', or else
+    'export_compression', is 'gzip' or 'zstd'. The temporary file is
+    always uncompressed, since it is read backwards, and so is a repair
+    file, which is merged into the original and removed straight away. If a
+    MediaStore is given as 'media', the file is written without waiting for
+    its downloads and passed to media.relink(); a repair file is merged at
+    once, so its downloads are waited for and linked as it is written.
     """
     current_time = time.strftime("%Y%m%d-%H%M%S")
+    compression = compression or export_compression
     
     if msg_ID:
-        f = open('%s_chat_history_repair.txt' % chat_ID, 'r')
-        final = open('%s_%s_chat_history_repair.html' % (chat_ID, chat_type), 'w')
+        f = open('%s_chat_history_repair.txt' % chat_ID, 'rb')
+        final_name = '%s_%s_chat_history_repair.html' % (chat_ID, chat_type)
+        final = open(final_name, 'w', output_buffer)
     else:
-        f = open('%s_chat_history.txt' % chat_ID, 'r')
-        final = open('%s_%s_chat_history_%s.html' % (chat_ID, chat_type, current_time), 'w')
+        f = open('%s_chat_history.txt' % chat_ID, 'rb')
+        final_name = ('%s_%s_chat_history_%s.html%s'
+                      % (chat_ID, chat_type, current_time,
+                         compressed_suffixes.get(compression, '')))
+        final = open_history(final_name, 'w')
 
     # Create the header and reference the CSS file.
-    header = (
-        '<!DOCTYPE html>\n<html>\n<body>\n'
-        '<head>\n'
-        '<link rel="stylesheet" href="styles.css" type="text/css">\n'
-        '</head>\n'
-        '<table>\n')
-    final.write(header)
+    final.write(html_header)
 
     # Correctly order the messages.
-    for line in reversed(f.readlines()):
-        final.write(line)
+    if media and msg_ID:
+        media.wait()
+        for line in reverse_lines(f):
+            final.write(media.link_local(line))
+    else:
+        for line in reverse_lines(f):
+            final.write(line)
 
     # Close out HTML formatting.
-    footer = '</table>\n</body>\n</html>'
-    final.write(footer)
+    final.write(html_footer)
 
     f.close()
     final.close()
@@ -244,6 +1917,507 @@ def format_history(chat_type, chat_ID, msg_ID):
         os.remove('%s_chat_history_repair.txt' % chat_ID)
     else:
         os.remove('%s_chat_history.txt' % chat_ID)
+        if media:
+            media.relink(final_name)
+
+# Rows of the index of a history written in volumes.
+index_row = ('<tr><td class="name"><a href="%s">%s</a></td> '
+             '<td class="hour">%i messages</td></tr>\n')
+
+def format_volumes(chat_type, chat_ID, split=volume_split, media=None):
+    """Write a chat's history as a directory of HTML files, or volumes, one
+    per calendar month or one per 'split' messages, and an index.html
+    linking the volumes with their message counts. A browser opens any one
+    volume quickly, however large the whole history is.
+
+    The temporary file is read backwards once, as in format_history(), and
+    each volume is written as its messages stream through; only the list of
+    volumes is held in memory. The temporary file is left for
+    format_history(). Volumes have no update details, so a history is
+    updated or repaired as a single file; error details of a retrieval cut
+    short are shown in the index. Each volume is passed to media.relink(),
+    if a MediaStore is given as 'media', as in format_history(). Returns
+    the name of the index file.
+    """
+    current_time = time.strftime("%Y%m%d-%H%M%S")
+    directory = '%s_%s_chat_history_%s' % (chat_ID, chat_type, current_time)
+    if not os.path.isdir(directory):
+        os.mkdir(directory)
+    header = html_header.replace('"styles.css"', '"../styles.css"')
+    date_start = date_row.index('%s')
+
+    f = open('%s_chat_history.txt' % chat_ID, 'rb')
+    final = None
+    volumes = []  # [file name, month, first date, last date, messages]
+    errors = []
+    msg_count = 0
+    month = None
+    for line in reverse_lines(f):
+        # Hold each date back until a message follows it, so a volume never
+        # ends with a date or starts without one.
+        if line.startswith(date_row[:date_start]):
+            date_line = line
+            date = line[date_start:line.index('</td>')]
+            dated = False
+            if split == 'month':
+                # Dates end with the month and year, e.g. 'September 2014'.
+                month = date.split(' ', 2)[2]
+            continue
+        elif not line.startswith('<tr>'):
+            if line.startswith('<h1>'):
+                errors.append(line)
+            continue
+
+        if split == 'month':
+            new_volume = not volumes or month != volumes[-1][1]
+        else:
+            new_volume = not volumes or msg_count == split
+
+        if new_volume:
+            if final:
+                volumes[-1][4] = msg_count
+                final.write(html_footer)
+                final.close()
+            if split == 'month':
+                name = '%s.html' % time.strftime(
+                    '%Y-%m', time.strptime(month, '%B %Y'))
+            else:
+                name = 'volume_%04i.html' % (len(volumes) + 1)
+            volumes.append([name, month, date, date, 0])
+            final = open(os.path.join(directory, name), 'w', output_buffer)
+            final.write(header)
+            msg_count = 0
+            dated = False
+        if not dated:
+            final.write(date_line)
+            volumes[-1][3] = date
+            dated = True
+
+        final.write(line)
+        msg_count += 1
+
+    f.close()
+    if final:
+        volumes[-1][4] = msg_count
+        final.write(html_footer)
+        final.close()
+
+    index_name = os.path.join(directory, 'index.html')
+    index = open(index_name, 'w')
+    index.write(header)
+    index.writelines(errors)
+    for name, month, first_date, last_date, msg_count in volumes:
+        if month:
+            label = month
+        elif first_date == last_date:
+            label = first_date
+        else:
+            label = '%s to %s' % (first_date, last_date)
+        index.write(index_row % (name, label, msg_count))
+    index.write(html_footer)
+    index.close()
+
+    if media:
+        for volume in volumes:
+            media.relink(os.path.join(directory, volume[0]), '../')
+
+    return index_name
+
+def render_history(archive, self_id, chat_type, chat_ID,
+                   compression=None):
+    """Write a chat's history from the archive into a formatted HTML file,
+    without any requests to the API.
+
+    The file is laid out the same way as one from format_history(), with the
+    messages read from the archive in chronological order, and is compressed
+    the same way. Returns the name of the file, or None if the archive holds
+    no messages of the chat.
+    """
+    chat_ID = str(chat_ID)
+    compression = compression or export_compression
+    newest = archive.execute(
+        'SELECT created_at, id FROM messages '
+        'WHERE chat_type = ? AND chat_ID = ? '
+        'ORDER BY created_at DESC, id DESC LIMIT 1',
+        (chat_type, chat_ID)).fetchone()
+    if not newest:
+        return None
+
+    current_time = time.strftime("%Y%m%d-%H%M%S")
+    file_name = ('%s_%s_chat_history_%s.html%s'
+                 % (chat_ID, chat_type, current_time,
+                    compressed_suffixes.get(compression, '')))
+    final = open_history(file_name, 'w')
+    final.write(html_header)
+
+    # Details of the most recent message, needed for updating chat histories.
+    newest_date = time.strftime('%A, %d %B %Y', time.localtime(newest[0]))
+    update_details = format_update_details(chat_type, chat_ID, newest[1],
+                                           newest_date)
+
+    messages = archive.execute(
+        'SELECT created_at, user_id, name, text, id FROM messages '
+        'WHERE chat_type = ? AND chat_ID = ? ORDER BY created_at, id',
+        (chat_type, chat_ID))
+
+    clock = LocalClock()
+    old_day = None
+    for epoch_time, user_id, name, text, msg_id in messages:
+        day, date, hour = clock.format(epoch_time)
+        line = format_message(hour, user_id, name, text, self_id)
+
+        # Separate messages by date. The update details follow the first date.
+        if day != old_day:
+            final.write(date_row % date)
+            if old_day is None:
+                final.write(update_details)
+            old_day = day
+
+        final.write(line)
+
+    final.write(html_footer)
+    final.close()
+
+    return file_name
+
+record_columns = ('id', 'created_at', 'user_id', 'name', 'text',
+                  'attachments', 'favorited_by')
+
+def write_jsonl(messages, f):
+    """Write messages read from the archive as JSON Lines, one object per
+    message. Strings are encoded with the json module's C encoder, which
+    escapes non-ASCII characters; attachments and likes are written as
+    stored, without being decoded first.
+    """
+    for (msg_id, epoch_time, user_id, name, text, attachments,
+         likes) in messages:
+        f.write('{"id": %s, "created_at": %i, "user_id": %s, "name": %s, '
+                '"text": %s, "attachments": %s, "favorited_by": %s}\n'
+                % (encode_json(msg_id), epoch_time, encode_json(user_id),
+                   encode_json(name),
+                   encode_json(text) if text is not None else 'null',
+                   attachments or '[]', likes or '[]'))
+
+def write_csv(messages, f):
+    """Write messages read from the archive as CSV with a header row.
+    Attachments and likes are written as JSON.
+    """
+    writer = csv.writer(f)
+    writer.writerow(record_columns)
+    for (msg_id, epoch_time, user_id, name, text, attachments,
+         likes) in messages:
+        writer.writerow((msg_id, epoch_time, user_id.encode('UTF-8'),
+                         name.encode('UTF-8'),
+                         text.encode('UTF-8') if text else '',
+                         attachments or '[]', likes or '[]'))
+
+record_writers = {'jsonl': write_jsonl, 'csv': write_csv}
+
+def export_records(archive, chat_type, chat_ID, file_format,
+                   compression=None):
+    """Write a chat's messages from the archive into a JSON Lines or CSV
+    file, for reading by other programs, and return the name of the file.
+    The file is compressed as it is written if 'compression', or else
+    'export_compression', is 'gzip' or 'zstd'.
+
+    Messages are stored in the archive as their pages are retrieved and are
+    read back in chronological order, so no temporary file or reversing is
+    needed. Message IDs, attachments and likes are kept.
+    """
+    chat_ID = str(chat_ID)
+    compression = compression or export_compression
+    current_time = time.strftime("%Y%m%d-%H%M%S")
+    file_name = ('%s_%s_chat_history_%s.%s%s'
+                 % (chat_ID, chat_type, current_time, file_format,
+                    compressed_suffixes.get(compression, '')))
+
+    messages = archive.execute(
+        'SELECT %s FROM messages '
+        'WHERE chat_type = ? AND chat_ID = ? ORDER BY created_at, id'
+        % ', '.join(record_columns), (chat_type, chat_ID))
+
+    f = open_history(file_name, 'wb')
+    record_writers[file_format](messages, f)
+    f.close()
+
+    return file_name
+
+def find_footer(f):
+    """Return the offset of the HTML footer in a chat history file opened in
+    binary mode, or None if it has none, and the line break the file was
+    written with.
+    """
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    f.seek(max(0, size - 64))
+    tail = f.read()
+
+    footer = tail.rfind('</table>')
+    if footer != -1:
+        footer += size - len(tail)
+    else:
+        footer = None
+    newline = '\r\n' if '\r\n' in tail else '\n'
+
+    return footer, newline
+
+def copy_range(src, dst, size):
+    """Copy 'size' bytes from the current position of one file to another,
+    'block_size' bytes at a time.
+    """
+    while size > 0:
+        block = src.read(min(block_size, size))
+        if not block:
+            break
+        dst.write(block)
+        size -= len(block)
+
+def merge_histories(chat_original, chat_repair, chat_fixed, date_duplicate):
+    """Merge a chat history file with its repair file into one file.
+
+    All files are opened in binary mode. The repair file holds the messages
+    before the original's earliest, so its messages come first, then the
+    original's. The merged file keeps the original's update details, since
+    the original holds the most recent messages, and the repair file's error
+    details if the repair was itself cut short.
+
+    Both files are copied in blocks rather than read into memory, so memory
+    use does not depend on the size of the histories.
+    """
+    # Write the header and earliest date of the repair file, followed by the
+    # original's update details. Update details are recorded in line 9 and
+    # messages (or error details) start at line 10.
+    for i in range(8):
+        chat_fixed.write(chat_repair.readline())
+    chat_repair.readline()
+
+    original_header = [chat_original.readline() for i in range(11)]
+    chat_fixed.write(original_header[8])
+
+    # Copy the repair messages, up to the repair file's footer.
+    start = chat_repair.tell()
+    footer, newline = find_footer(chat_repair)
+    chat_repair.seek(start)
+    copy_range(chat_repair, chat_fixed, footer - start)
+
+    # If the date of the latest 'repair messages' is not the same as the
+    # date of the earliest 'original messages', make sure to distinguish
+    # the dates of the those sets of messages.
+    if not date_duplicate:
+        chat_fixed.write(original_header[7])
+
+    # Original chat messages start at line 12, and run to the end of the
+    # file, footer included.
+    shutil.copyfileobj(chat_original, chat_fixed, block_size)
+
+def get_update_details(chat_name):
+    """Given a chat history file name, return details of the most recent
+    message. This includes the chat type and ID and the most recent message
+    ID and its date. If the file has no details or does not exist, return
+    None.
+    """
+    try:
+        update_line = ""
+
+        # Get the line in the chat containing update and chat details.
+        file = open_history(chat_name)
+        for i, line in enumerate(file):
+            if i == 8: # Update details are recorded in line 9 of file.
+                update_line = line
+            elif i > 8:
+                break
+        file.close()
+        update_details = re.search('<p hidden update>(.*)</p>', update_line)
+        return update_details
+    except:
+        return None
+
+def get_new_records(token, chat_type, chat_ID, after_id):
+    """Return the records of a chat's messages sent after the message
+    'after_id', oldest first.
+
+    Pages are retrieved from the most recent message backwards and retrieval
+    stops at 'after_id', so only pages holding new messages are requested.
+    Direct message chats cannot be paged forwards with 'after_id', so both
+    chat types are paged the same way.
+    """
+    if chat_type == 'group':
+        msg = 'messages'
+    elif chat_type == 'direct':
+        msg = 'direct_messages'
+
+    url = get_URL(token, chat_type, chat_ID, None)
+    json = get_json(url)
+    page = [get_record(message) for message in json['response'][msg]]
+
+    records = []
+    while page:
+        for record in page:
+            if int(record[4]) <= int(after_id):
+                records.reverse()
+                return records
+            records.append(record)
+
+        if len(page) < message_limit:
+            break
+        try:
+            page = get_page('%s&before_id=%s' % (url, page[-1][4]))
+        except urllib2.HTTPError, err:
+            if err.code != 304:
+                raise
+            break
+
+    records.reverse()
+    return records
+
+def set_update_details(chat_name, chat_type, chat_ID, after_id, date):
+    """Replace the hidden update line of a chat history file.
+
+    The line is overwritten in place when the new details fit in it, which
+    they do in files padded by format_update_details(). Otherwise the file
+    is copied once with the new line.
+    """
+    f = open(chat_name, 'r+b')
+
+    # Update details are recorded in line 9 of file.
+    offset = 0
+    for i in range(8):
+        offset += len(f.readline())
+    old_line = f.readline()
+    newline = old_line[len(old_line.rstrip('\r\n')):]
+    width = len(old_line) - len(newline)
+
+    new_line = format_update_details(chat_type, chat_ID, after_id, date, width)
+    new_line = new_line.replace('\n', newline)
+    if len(new_line) == len(old_line):
+        f.seek(offset)
+        f.write(new_line)
+        f.close()
+        return
+
+    f.seek(0)
+    copy = open('%s.tmp' % chat_name, 'wb')
+    for i in range(8):
+        copy.write(f.readline())
+    f.readline()
+    copy.write(new_line)
+    shutil.copyfileobj(f, copy)
+    copy.close()
+    f.close()
+    replace_file('%s.tmp' % chat_name, chat_name)
+
+def update_compressed(chat_name, data, chat_type, chat_ID, after_id, date):
+    """Put formatted messages in place of the HTML footer of a compressed
+    chat history file, and replace its hidden update line.
+
+    A compressed file cannot be changed in place, so it is copied once,
+    decompressed and compressed again as it streams through. Only the last
+    block is held back, to find the footer in. Raise ValueError if the file
+    has no HTML footer.
+    """
+    root, suffix = os.path.splitext(chat_name)
+    temp_name = '%s.tmp%s' % (root, suffix)
+    f = open_history(chat_name)
+    copy = open_history(temp_name, 'wb')
+
+    # Update details are recorded in line 9 of file.
+    for i in range(8):
+        copy.write(f.readline())
+    old_line = f.readline()
+    newline = old_line[len(old_line.rstrip('\r\n')):]
+    width = len(old_line) - len(newline)
+    new_line = format_update_details(chat_type, chat_ID, after_id, date, width)
+    copy.write(new_line.replace('\n', newline))
+
+    tail = ''
+    block = f.read(block_size)
+    while block:
+        tail += block
+        if len(tail) > block_size:
+            copy.write(tail[:-64])
+            tail = tail[-64:]
+        block = f.read(block_size)
+    f.close()
+
+    footer = tail.rfind('</table>')
+    if footer == -1:
+        copy.close()
+        os.remove(temp_name)
+        raise ValueError('%s has no HTML footer' % chat_name)
+    newline = '\r\n' if '\r\n' in tail else '\n'
+    copy.write(tail[:footer])
+    copy.write(data.replace('\n', newline))
+    copy.close()
+    replace_file(temp_name, chat_name)
+
+def update_chat(token, self_id, chat_name, archive=None):
+    """Add the messages sent since a chat history file was retrieved to the
+    end of the file. Return the number of messages added.
+
+    The file's hidden update line records the most recent message it holds;
+    only messages after it are retrieved. The new messages replace the HTML
+    footer at the end of the file and the update line is rewritten, so the
+    rest of the file is left as it is. A compressed file is copied once
+    instead, by update_compressed(). Raise ValueError if the file is not a
+    chat history file with update details.
+    """
+    update_details = get_update_details(chat_name)
+    if not update_details:
+        raise ValueError('%s has no update details' % chat_name)
+    update_details = update_details.group(1).split()
+    chat_type = update_details[0]
+    chat_ID = update_details[1]
+    after_id = update_details[2]
+    old_date = ' '.join(update_details[3:])
+
+    records = get_new_records(token, chat_type, chat_ID, after_id)
+    if not records:
+        return 0
+    if archive:
+        store_page(archive, chat_type, chat_ID, records)
+
+    # Format the new messages, then close out HTML formatting again.
+    clock = LocalClock()
+    old_day = None
+    chunks = []
+    for (epoch_time, user_id, name, text, msg_id, attachments,
+         likes) in records:
+        day, date, hour = clock.format(epoch_time)
+        line = format_message(hour, user_id, name, text, self_id)
+
+        # Separate messages by date. Only the file's latest date is known as
+        # a formatted date, not a day number.
+        if day != old_day:
+            if date != old_date:
+                chunks.append(date_row % date)
+            old_day = day
+            old_date = date
+
+        chunks.append(line)
+    chunks.append(html_footer)
+    data = ''.join(chunks)
+
+    if get_compression(chat_name):
+        update_compressed(chat_name, data, chat_type, chat_ID,
+                          records[-1][4], old_date)
+        return len(records)
+
+    f = open(chat_name, 'r+b')
+
+    footer, newline = find_footer(f)
+    if footer is None:
+        f.close()
+        raise ValueError('%s has no HTML footer' % chat_name)
+
+    # Write the new messages in place of the footer.
+    f.seek(footer)
+    f.truncate()
+    f.write(data.replace('\n', newline))
+    f.close()
+
+    set_update_details(chat_name, chat_type, chat_ID, records[-1][4], old_date)
+
+    return len(records)
 
 def create_css():
     """Create a CSS file to format the HTML file."""
@@ -314,6 +2488,680 @@ def create_css():
             '}\n')
         f.close()
 
+def export_chat(token, self_id, chat_type, chat_ID, formats=export_formats,
+                msg_ID=None, progress=None, cancel=None, media=None,
+                compression=None):
+    """Retrieve a chat's history into a file of each of the given formats.
+    An interrupted retrieval of the chat is resumed from its last
+    checkpoint.
+
+    Returns the number of messages in the chat and what create_history()
+    returned: None, or the code recorded if retrieval stopped early.
+
+    'html' is the formatted chat history and 'volumes' the same history
+    split by format_volumes(); 'jsonl' and 'csv' are written from the archive
+    by export_records(). If 'msg_ID' is given, only the messages before it
+    are retrieved, into an HTML repair file. 'progress' and 'cancel' are
+    passed on to create_history(). The HTML and record files are compressed
+    by 'compression', or else 'export_compression', as in format_history();
+    a repair file never is.
+
+    Attachments are downloaded into 'media', a MediaStore, and linked from
+    the HTML. If none is given and 'download_media' is set, one is opened
+    for the chat and closed once it is written.
+    """
+    if media is None and download_media:
+        media = MediaStore()
+        try:
+            return export_chat(token, self_id, chat_type, chat_ID, formats,
+                               msg_ID, progress, cancel, media, compression)
+        finally:
+            media.close()
+
+    # Rows are only rendered for the formats written from them.
+    if msg_ID:
+        formats = ('html',)
+    render = 'html' in formats or 'volumes' in formats
+
+    url = get_URL(token, chat_type, chat_ID, None)
+    checkpoint = read_checkpoint(chat_type, chat_ID, msg_ID, render)
+    if checkpoint:
+        json = get_json(get_URL(token, chat_type, chat_ID,
+                                checkpoint['before_id']), cancel)
+    else:
+        json = get_json(get_URL(token, chat_type, chat_ID, msg_ID), cancel)
+
+    msg_count = json['response']['count']
+    stopped = None
+    if msg_count != 0:
+        archive = open_archive()
+        try:
+            stopped = create_history(json, url, self_id, chat_type, chat_ID,
+                                     msg_count, message_limit, msg_ID,
+                                     archive, checkpoint, progress, cancel,
+                                     media, render)
+            for file_format in formats:
+                if file_format in record_writers:
+                    start = phases.start()
+                    name = export_records(archive, chat_type, chat_ID,
+                                          file_format, compression)
+                    phases.add('export %s' % file_format, start,
+                               os.path.getsize(name))
+        finally:
+            archive.close()
+
+        # Formatting reads the temporary file, so its size is the bytes
+        # counted for it.
+        if msg_ID:
+            temp_size = os.path.getsize('%s_chat_history_repair.txt' % chat_ID)
+        else:
+            temp_size = os.path.getsize('%s_chat_history.txt' % chat_ID)
+        if 'volumes' in formats:
+            start = phases.start()
+            format_volumes(chat_type, chat_ID, media=media)
+            phases.add('volumes', start, temp_size)
+        if 'html' in formats:
+            start = phases.start()
+            format_history(chat_type, chat_ID, msg_ID, compression, media)
+            phases.add('format', start, temp_size)
+        else:
+            os.remove('%s_chat_history.txt' % chat_ID)
+
+    return msg_count, stopped
+
+def get_error_details(chat_name):
+    """Given a chat history file name whose history was not fully
+    retrieved, return error details recorded when retrieval was prematurely
+    terminated. These errors include the chat type and ID and message ID
+    and its date. If no errors are found or if the file does not exist,
+    return None.
+    """
+    try:
+        error_line = ""
+
+        # Get the line in the chat containing error and chat details.
+        file = open_history(chat_name)
+        for i, line in enumerate(file):
+            if i == 10: # Error details are recorded in line 11 of file.
+                error_line = line
+            elif i > 10:
+                break
+        file.close()
+        error_details = re.search('<p hidden repair>(.*)</p>', error_line)
+        return error_details
+    except:
+        return None
+
+def has_attachment_links(chat_name):
+    """Return whether a chat history file links any attachments, as one
+    written with a MediaStore does.
+    """
+    f = open_history(chat_name)
+    try:
+        for line in f:
+            if 'class="attachment"' in line:
+                return True
+    finally:
+        f.close()
+    return False
+
+def repair_chat(token, self_id, chat_name, progress=None, cancel=None,
+                media=None):
+    """Retrieve the messages missing from a chat history file whose
+    retrieval was cut short, and merge them into a new file in place of the
+    original. Return the name of the new file.
+
+    Attachments of the missing messages are downloaded into 'media', a
+    MediaStore, and linked as in export_chat(). If none is given, one is
+    opened for the repair if 'download_media' is set or the original file
+    links attachments, so the repaired part is linked like the rest.
+
+    Raise ValueError if the file has no error details to repair from, or
+    the chat has no messages before them.
+    """
+    if media is None and (download_media or has_attachment_links(chat_name)):
+        media = MediaStore()
+        try:
+            return repair_chat(token, self_id, chat_name, progress, cancel,
+                               media)
+        finally:
+            media.close()
+
+    error_details = get_error_details(chat_name)
+    if not error_details:
+        raise ValueError('%s has no error details' % chat_name)
+    error_details = error_details.group(1).split()
+    chat_type = error_details[0]
+    chat_ID = error_details[1]
+    last_message_ID = error_details[2]
+    earliest_date = error_details[3:]
+
+    msg_count, stopped = export_chat(token, self_id, chat_type, chat_ID,
+                                     msg_ID=last_message_ID,
+                                     progress=progress, cancel=cancel,
+                                     media=media)
+    if not msg_count:
+        raise ValueError('%s has no messages before %s'
+                         % (chat_name, last_message_ID))
+
+    # Get the latest message date of the repair chat history file and
+    # compare it to the earliest message date of original history file.
+    # Needed to avoid writing the same date twice.
+    chat_repair_name = '%s_%s_chat_history_repair.html' % (chat_ID, chat_type)
+    update_details = get_update_details(chat_repair_name)
+    latest_date = update_details.group(1).split()[3:]
+    date_duplicate = latest_date == earliest_date
+
+    # The merged file is compressed the same way as the original.
+    current_time = time.strftime("%Y%m%d-%H%M%S")
+    compression = get_compression(chat_name)
+    chat_fixed_name = ('%s_%s_chat_history_%s.html%s'
+                       % (chat_ID, chat_type, current_time,
+                          compressed_suffixes.get(compression, '')))
+    chat_original = open_history(chat_name)
+    chat_repair = open(chat_repair_name, 'rb')
+    chat_fixed = open_history(chat_fixed_name, 'wb')
+
+    merge_histories(chat_original, chat_repair, chat_fixed, date_duplicate)
+
+    chat_fixed.close()
+    chat_original.close()
+    chat_repair.close()
+
+    os.remove(chat_name)
+    os.remove(chat_repair_name)
+
+    return chat_fixed_name
+
+def export_all(token, chats, concurrency=export_concurrency, progress=None,
+               formats=export_formats, cancel=None, compression=None):
+    """Retrieve the histories of many chats at once.
+
+    Parameters:
+        token: The user's access token.
+        chats: A list of [chat_type, chat_ID] pairs.
+        concurrency: The number of chats retrieved at the same time.
+        progress: Optional function called as progress(done, total) each
+            time a chat finishes.
+        formats: The formats each chat's history is written in, as for
+            export_chat().
+        cancel: Optional threading.Event. Once it is set, chats being
+            retrieved stop as in create_history() and the rest are skipped.
+        compression: How each chat's files are compressed, as for
+            export_chat().
+
+    Returns a list of [chat_type, chat_ID, msg_count, error] for each chat,
+    in the order the chats finished. 'error' is None, 'cancelled', or the
+    exception that stopped the chat's retrieval. As with a single chat, an
+    HTTPError during retrieval leaves a repair marker in the chat's history
+    instead, and 'error' is the code recorded in it. If 'download_media' is
+    set, one MediaStore is shared by every chat, so a file posted in several
+    chats is downloaded once.
+    """
+    self_id = get_self_id(token)
+    if 'html' in formats or 'volumes' in formats:
+        create_css()
+    media = MediaStore() if download_media else None
+
+    def export(chat):
+        chat_type, chat_ID = chat
+        if cancel and cancel.is_set():
+            return [chat_type, chat_ID, 0, 'cancelled']
+        try:
+            msg_count, stopped = export_chat(token, self_id, chat_type,
+                                             chat_ID, formats, cancel=cancel,
+                                             media=media,
+                                             compression=compression)
+            return [chat_type, chat_ID, msg_count, stopped]
+        except Exception, err:
+            if cancel and cancel.is_set():
+                return [chat_type, chat_ID, 0, 'cancelled']
+            return [chat_type, chat_ID, 0, err]
+
+    results = []
+    workers = ThreadPool(concurrency)
+    try:
+        for result in workers.imap_unordered(export, chats):
+            results.append(result)
+            if progress:
+                progress(len(results), len(chats))
+    finally:
+        workers.close()
+        if media:
+            media.close()
+
+    return results
+
+def summarize_export(results, seconds):
+    """Return a one-line summary of the results of export_all()."""
+    msg_count = sum(result[2] for result in results)
+    failed = [result for result in results if result[3]]
+
+    summary = ("Retrieved %i of %i chats (%i messages) in %i seconds"
+               % (len(results) - len(failed), len(results), msg_count,
+                  seconds))
+    if failed:
+        summary += "; failed: %s" % ', '.join(
+            '%s %s (%s)' % (chat_type, chat_ID, err)
+            for chat_type, chat_ID, msg_count, err in failed)
+
+    return summary
+
+def parse_date(date):
+    """Return the local midnight starting a YYYY-MM-DD date, in seconds
+    since the epoch.
+    """
+    try:
+        return time.mktime(time.strptime(date, '%Y-%m-%d'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('%r is not a YYYY-MM-DD date'
+                                         % date)
+
+def search_main(args):
+    """Search the archive from the command line and print the matching
+    messages, most recent first. Return the exit status.
+    """
+    parser = argparse.ArgumentParser(
+        prog='%s search' % os.path.basename(sys.argv[0]),
+        description='Search every chat retrieved into the archive.')
+    parser.add_argument('query', help='words to find; "quote" phrases')
+    parser.add_argument('--sender', help='user ID or name of the sender')
+    parser.add_argument('--since', type=parse_date,
+                        help='only messages sent on or after YYYY-MM-DD')
+    parser.add_argument('--until', type=parse_date,
+                        help='only messages sent before YYYY-MM-DD')
+    parser.add_argument('--chat', help='only messages of this chat ID')
+    parser.add_argument('--limit', type=int, default=search_limit,
+                        help='most messages shown (default %(default)s)')
+    parser.add_argument('--archive', default=archive_name,
+                        help='archive file (default %(default)s)')
+    options = parser.parse_args(args)
+
+    encoding = sys.getfilesystemencoding() or 'UTF-8'
+    sender = options.sender and options.sender.decode(encoding)
+    if not os.path.isfile(options.archive):
+        print "No archive found at %s." % options.archive
+        return 1
+    archive = open_archive(options.archive)
+    try:
+        results = search_archive(archive, options.query.decode(encoding),
+                                 sender, options.since, options.until,
+                                 options.chat, options.limit)
+    except sqlite3.OperationalError, err:
+        print "Cannot search the archive: %s" % err
+        return 1
+    finally:
+        archive.close()
+
+    clock = LocalClock()
+    for chat_type, chat_ID, created_at, name, text in results:
+        day, date, hour = clock.format(created_at)
+        line = u'%s %s  %s %s  %s: %s' % (date, hour, chat_type, chat_ID,
+                                         name, text or u'')
+        print line.encode(sys.stdout.encoding or 'UTF-8', 'replace')
+
+    return 0
+
+def render_main(args):
+    """Write chat histories from the archive into HTML files from the
+    command line, without any requests for their messages, and return the
+    exit status: 0 once every chat is written, 1 if there is no archive,
+    2 if a chat is not in the archive or the token cannot be read, and 3 if
+    the user's ID cannot be looked up.
+    """
+    parser = argparse.ArgumentParser(
+        prog='%s render' % os.path.basename(sys.argv[0]),
+        description='Write the histories of chats already retrieved into '
+                    'the archive, without retrieving them again.')
+    parser.add_argument('chats', nargs='+', metavar='CHAT',
+                        help='"all", or the ID of an archived chat')
+    parser.add_argument('--type', choices=('group', 'direct'),
+                        help='only select chats of this type')
+    parser.add_argument('--self-id', help="the user's ID, whose messages "
+                                          "are marked; looked up with the "
+                                          "token if there is one")
+    parser.add_argument('--token-file', help='file holding the access token')
+    parser.add_argument('--output', default='.',
+                        help='directory the histories are written to '
+                             '(default the current directory)')
+    parser.add_argument('--compress', choices=('gzip', 'zstd'),
+                        help='compress the histories as they are written')
+    parser.add_argument('--archive', default=archive_name,
+                        help='archive file (default %(default)s)')
+    options = parser.parse_args(args)
+    if options.compress == 'zstd' and not zstandard:
+        parser.error('--compress zstd needs the zstandard package')
+
+    if not os.path.isfile(options.archive):
+        print "No archive found at %s." % options.archive
+        return 1
+    archive = open_archive(os.path.abspath(options.archive))
+    try:
+        chats = archive.execute(
+            'SELECT DISTINCT chat_type, chat_ID FROM messages').fetchall()
+        if options.type:
+            chats = [chat for chat in chats if chat[0] == options.type]
+        selected = []
+        for selector in options.chats:
+            matched = [chat for chat in chats if selector in ('all', chat[1])]
+            if not matched:
+                print "Chat %s is not in the archive." % selector
+                return 2
+            selected.extend(chat for chat in matched if chat not in selected)
+
+        # Only the user's ID may need the API, and it is usually cached.
+        self_id = options.self_id
+        try:
+            token = read_token(options.token_file)
+        except IOError, err:
+            print >> sys.stderr, "Cannot read the token: %s" % err
+            return 2
+        if not self_id and token:
+            try:
+                self_id = get_self_id(token)
+            except (urllib2.URLError, httplib.HTTPException, socket.error,
+                    ValueError), err:
+                print >> sys.stderr, "Cannot look up your user ID: %s" % err
+                return 3
+
+        if not os.path.isdir(options.output):
+            os.makedirs(options.output)
+        os.chdir(options.output)
+        create_css()
+        for chat_type, chat_ID in selected:
+            name = render_history(archive, self_id, chat_type, chat_ID,
+                                  options.compress)
+            print "%s %s  %s" % (chat_type, chat_ID, name)
+    finally:
+        archive.close()
+
+    return 0
+
+def read_token(name=None):
+    """Return the access token kept in the file 'name', or if no name is
+    given, in the 'token_variable' environment variable. Return None if
+    there is none.
+    """
+    if name:
+        f = open(name)
+        token = f.read()
+        f.close()
+    else:
+        token = os.environ.get(token_variable, '')
+
+    return token.strip() or None
+
+def select_chats(chats, selectors, chat_type=None):
+    """Return the [chat_type, chat_ID, name] of each chat matched by any
+    of 'selectors', in the order of 'chats'.
+
+    A selector is 'all', a chat ID, or a shell-style pattern matched against
+    chat names regardless of case. Only chats of 'chat_type' are matched if
+    it is given. Raise ValueError naming a selector that matches no chat.
+    """
+    if chat_type:
+        chats = [chat for chat in chats if chat[0] == chat_type]
+
+    selected = set()
+    for selector in selectors:
+        pattern = selector.lower()
+        matched = [i for i, (kind, ID, name) in enumerate(chats)
+                   if selector in ('all', ID)
+                   or fnmatch.fnmatchcase(name.lower(), pattern)]
+        if not matched:
+            raise ValueError(u'no chat matches "%s"' % selector)
+        selected.update(matched)
+
+    return [chats[i] for i in sorted(selected)]
+
+def export_main(args):
+    """Export chats from the command line, without the window, and return
+    the exit status:
+
+        0  every selected chat was retrieved in full.
+        1  some chats failed or stopped early; see the summary printed.
+        2  the arguments were wrong, no token was given, or a chat to
+           export was not found.
+        3  the token was rejected, or the chats could not be listed.
+        4  the export was interrupted by SIGINT or SIGTERM. Chats being
+           retrieved are finished with repair markers, as when cancelled.
+    """
+    parser = argparse.ArgumentParser(
+        prog='%s export' % os.path.basename(sys.argv[0]),
+        description='Retrieve the histories of chats without the window. '
+                    'The token is read from --token-file, or else from '
+                    'the %s environment variable.' % token_variable,
+        epilog='Exits with 0 once every chat is retrieved in full, 1 if '
+               'some failed or stopped early, 2 on bad arguments, 3 if '
+               'the token was rejected, and 4 if interrupted.')
+    parser.add_argument('chats', nargs='*', metavar='CHAT',
+                        help='"all", a chat ID, or a pattern such as '
+                             '"*family*" matched against chat names')
+    parser.add_argument('--type', choices=('group', 'direct'),
+                        help='only select chats of this type')
+    parser.add_argument('--list', action='store_true',
+                        help='list the chats that would be exported and exit')
+    parser.add_argument('--token-file', help='file holding the access token')
+    parser.add_argument('--output', default='.',
+                        help='directory the histories are written to '
+                             '(default the current directory)')
+    parser.add_argument('--format', action='append', dest='formats',
+                        choices=('html', 'volumes', 'jsonl', 'csv'),
+                        help='format written; may be repeated '
+                             '(default %s)' % ', '.join(export_formats))
+    parser.add_argument('--compress', choices=('gzip', 'zstd'),
+                        help='compress the histories as they are written')
+    parser.add_argument('--concurrency', type=int,
+                        default=export_concurrency,
+                        help='chats retrieved at once (default %(default)s)')
+    parser.add_argument('--media', action='store_true',
+                        help='also download attachments and link them')
+    parser.add_argument('--timing', action='store_true',
+                        help='print a timing breakdown once done')
+    parser.add_argument('--metrics',
+                        help='file request metrics are written to')
+    parser.add_argument('--profile', help='file cProfile statistics are '
+                                          'dumped to')
+    parser.add_argument('--quiet', action='store_true',
+                        help='print only the summary and errors')
+    options = parser.parse_args(args)
+    if not options.chats and not options.list:
+        parser.error('no chats given; use "all" to export every chat')
+    if options.concurrency < 1:
+        parser.error('--concurrency must be at least 1')
+    if options.compress == 'zstd' and not zstandard:
+        parser.error('--compress zstd needs the zstandard package')
+
+    try:
+        token = read_token(options.token_file)
+    except IOError, err:
+        print >> sys.stderr, "Cannot read the token: %s" % err
+        return 2
+    if not token:
+        print >> sys.stderr, ("No token given; set %s or use --token-file."
+                              % token_variable)
+        return 2
+
+    try:
+        chats = ([['group', ID, name] for ID, name in get_groups(token)] +
+                 [['direct', ID, name] for ID, name in get_directs(token)])
+    except urllib2.HTTPError, err:
+        print >> sys.stderr, "Cannot list the chats: HTTP Error %s" % err.code
+        return 3
+    except (urllib2.URLError, httplib.HTTPException, socket.error,
+            ValueError), err:
+        print >> sys.stderr, "Cannot list the chats: %s" % err
+        return 3
+
+    encoding = sys.getfilesystemencoding() or 'UTF-8'
+    output = sys.stdout.encoding or 'UTF-8'
+    try:
+        chats = select_chats(chats, [selector.decode(encoding)
+                                     for selector in options.chats or ['all']],
+                             options.type)
+    except ValueError, err:
+        print >> sys.stderr, (u"Cannot select the chats: %s"
+                              % err.args[0]).encode(output, 'replace')
+        return 2
+    names = dict(((chat_type, ID), name) for chat_type, ID, name in chats)
+    if options.list:
+        for chat_type, ID, name in chats:
+            print (u'%s %s  %s' % (chat_type, ID, name)).encode(output,
+                                                                'replace')
+        return 0
+
+    # Files are written relative to the output directory, so paths given
+    # on the command line are resolved first.
+    global download_media, metrics_name, profile_name
+    download_media = download_media or options.media
+    if options.metrics:
+        metrics_name = os.path.abspath(options.metrics)
+    if options.profile:
+        profile_name = os.path.abspath(options.profile)
+    phases.enabled = phases.enabled or options.timing
+    if not os.path.isdir(options.output):
+        os.makedirs(options.output)
+    os.chdir(options.output)
+
+    # Signals only reach the main thread between its own calls, so the
+    # export runs on another thread while this one waits for it. A signal
+    # cancels the export, which finishes the chats being retrieved.
+    cancel = threading.Event()
+    def interrupt(signum, frame):
+        cancel.set()
+    signal.signal(signal.SIGINT, interrupt)
+    signal.signal(signal.SIGTERM, interrupt)
+
+    def progress(done, total):
+        if not options.quiet:
+            print "%i of %i chats done" % (done, total)
+
+    outcome = []
+    def export():
+        try:
+            outcome.append(run_profiled(
+                export_all, token, [chat[:2] for chat in chats],
+                options.concurrency, progress,
+                options.formats or export_formats, cancel,
+                options.compress))
+        except Exception, err:
+            outcome.append(err)
+
+    start = time.time()
+    thread = threading.Thread(target=export)
+    thread.daemon = True
+    thread.start()
+    while thread.is_alive():
+        thread.join(1)
+
+    results = outcome[0]
+    if isinstance(results, urllib2.HTTPError):
+        print >> sys.stderr, "Export failed: HTTP Error %s" % results.code
+        return 3
+    elif isinstance(results, Exception):
+        print >> sys.stderr, "Export failed: %s" % results
+        return 1
+
+    if not options.quiet:
+        for chat_type, chat_ID, msg_count, err in results:
+            line = u'%s %s  %s: %i messages' % (
+                chat_type, chat_ID, names[chat_type, chat_ID], msg_count)
+            if err:
+                line += u' (%s)' % err
+            print line.encode(output, 'replace')
+    print summarize_export(results, time.time() - start)
+
+    if cancel.is_set():
+        return 4
+    elif any(result[3] for result in results):
+        return 1
+    return 0
+
+# The commands run before PyQt4 is imported, since only the window needs it.
+commands = {'export': export_main, 'render': render_main,
+            'search': search_main}
+
+if __name__ == '__main__' and sys.argv[1:2] and sys.argv[1] in commands:
+    sys.exit(commands[sys.argv[1]](sys.argv[2:]))
+
+from PyQt4 import QtGui, QtCore
+
+class RetrievalWorker(QtCore.QThread):
+    """Run retrievals one after another on a background thread, so that the
+    window stays responsive while they run.
+
+    Jobs may be queued with add() while another job is running. A job is a
+    function called as function(progress, cancel) on the worker's thread,
+    returning a message to show once it finishes. Jobs must not touch any
+    widgets: they report through 'progress', as create_history() does, and
+    the worker passes each report on as a 'progressed' signal with the rate
+    so far and the estimated seconds left (-1 while unknown). Reports that
+    carry no estimate of their own are projected at the rate so far. Jobs
+    are run by run_profiled(), so they are timed and profiled when enabled.
+    """
+    progressed = QtCore.pyqtSignal(object, object, int, int, float, float)
+    finished_job = QtCore.pyqtSignal(object, object)
+
+    def __init__(self, parent=None):
+        QtCore.QThread.__init__(self, parent)
+        self.jobs = Queue.Queue()
+        self.cancel = threading.Event()
+
+    def add(self, label, unit, function):
+        """Queue a job. 'label' names it and 'unit' names what it counts in
+        progress reports.
+        """
+        self.jobs.put((label, unit, function))
+
+    def pending(self):
+        """Return the number of jobs waiting to run."""
+        return self.jobs.qsize()
+
+    def cancel_all(self):
+        """Drop the queued jobs and cancel the running one."""
+        try:
+            while True:
+                self.jobs.get_nowait()
+        except Queue.Empty:
+            pass
+        self.cancel.set()
+
+    def stop(self):
+        """Cancel all jobs and end the thread once the running job stops,
+        without waiting for it.
+        """
+        self.cancel_all()
+        self.jobs.put(None)
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            label, unit, function = job
+            self.cancel.clear()
+            start = time.time()
+
+            def progress(done, total, seconds_left=None):
+                elapsed = time.time() - start
+                rate = done / elapsed if elapsed > 0 else 0.0
+                if seconds_left is not None:
+                    eta = seconds_left
+                else:
+                    eta = (total - done) / rate if rate else -1.0
+                self.progressed.emit(label, unit, done, total, rate, eta)
+
+            try:
+                message = run_profiled(function, progress, self.cancel)
+            except Exception, err:
+                if self.cancel.is_set():
+                    message = "Retrieving %s was cancelled." % label
+                elif isinstance(err, urllib2.HTTPError):
+                    message = "HTTP Error %s. Try again later." % err.code
+                else:
+                    message = "Retrieving %s failed: %s" % (label, err)
+            self.finished_job.emit(label, message)
+
 class AppWindow(QtGui.QDialog):
     """This is the main application window users interact with."""
     def __init__(self, msg_limit):
@@ -350,6 +3198,30 @@ class AppWindow(QtGui.QDialog):
 
         self.setLayout(self.layout)
 
+        # Retrievals run on a worker thread, one after another.
+        self.worker = RetrievalWorker()
+        self.worker.progressed.connect(self.show_progress)
+        self.worker.finished_job.connect(self.finish_job)
+        self.worker.start()
+
+    def closeEvent(self, event):
+        """Stop any retrieval before the window closes. A retrieval stopped
+        this way leaves a repair marker, as when cancelled. The window is
+        hidden at once and the application quits once the worker ends, so
+        the window never waits on it.
+        """
+        if not self.worker.isRunning():
+            event.accept()
+            return
+
+        quit = QtCore.QCoreApplication.instance().quit
+        self.worker.finished.connect(quit)
+        self.worker.stop()
+        self.hide()
+        event.ignore()
+        if self.worker.isFinished():
+            quit()
+
     def check_token(self, token):
         """Check the validity of the access token."""
         try:
@@ -364,8 +3236,8 @@ class AppWindow(QtGui.QDialog):
         """Find and list the chats available."""
         self.setWindowTitle("Loading...")
 
-        token = str(self.token.text())  # obtain user-inputted token
-        self.token_str = token.strip()
+        token = str(self.token.text()).strip()  # obtain user-inputted token
+        self.token_str = token
         valid = self.check_token(token)
 
         # Find all chats if the given token is valid.
@@ -383,6 +3255,11 @@ class AppWindow(QtGui.QDialog):
                 self.group_list.clear()
                 self.direct_list.clear()
 
+            # Finding chats is asked for explicitly, so the lists are
+            # requested again rather than taken from the cache.
+            account_cache.invalidate(token, 'groups')
+            account_cache.invalidate(token, 'directs')
+
             # Show the chat names.
             self.groups = get_groups(token)
             for i in self.groups:
@@ -412,6 +3289,16 @@ class AppWindow(QtGui.QDialog):
                 self.direct_btn = QtGui.QPushButton(
                     "Get Direct Message Chat History", self)
                 self.direct_btn.clicked.connect(self.get_direct_history)
+                self.all_btn = QtGui.QPushButton(
+                    "Get All Chat Histories", self)
+                self.all_btn.clicked.connect(self.get_all_histories)
+                self.stop_btn = QtGui.QPushButton(
+                    "Stop Retrieving", self)
+                self.stop_btn.clicked.connect(self.stop_retrieval)
+                self.timing_box = QtGui.QCheckBox(
+                    "Print a timing breakdown of each retrieval", self)
+                self.timing_box.setChecked(phases.enabled)
+                self.timing_box.toggled.connect(self.set_timing)
 
                 # Initialize the status bar.
                 self.status = QtGui.QStatusBar()
@@ -427,6 +3314,10 @@ class AppWindow(QtGui.QDialog):
                 self.layout.addWidget(self.direct_list)
                 self.layout.addWidget(self.direct_btn)
                 self.layout.addWidget(QtGui.QLabel(""))
+                self.layout.addWidget(self.all_btn)
+                self.layout.addWidget(self.stop_btn)
+                self.layout.addWidget(self.timing_box)
+                self.layout.addWidget(QtGui.QLabel(""))
                 
                 # Create line for file selection (for repairing and updating).
                 self.file_line = QtGui.QLineEdit()
@@ -466,21 +3357,71 @@ class AppWindow(QtGui.QDialog):
 
     def get_group_history(self):
         """Retrieve group chat history."""
-        group_id = self.groups[self.group_list.currentRow()][0]
+        group_id, group_name = self.groups[self.group_list.currentRow()]
 
-        self.get_chat(self.token_str, 'group', group_id)
+        self.get_chat(self.token_str, 'group', group_id, label=group_name)
 
     def get_direct_history(self):
         """Retrieve direct message chat history."""
-        direct_id = self.directs[self.direct_list.currentRow()][0]
+        direct_id, direct_name = self.directs[self.direct_list.currentRow()]
 
-        self.get_chat(self.token_str, 'direct', direct_id)
+        self.get_chat(self.token_str, 'direct', direct_id, label=direct_name)
 
-    def get_runtime(self, msg_count):
-        """Estimate the time to retrieve the chat history based on the
-        number of messages in the selected chat.
+    def get_all_histories(self):
+        """Retrieve the histories of every listed group and direct message
+        chat.
+        """
+        token = self.token_str
+        chats = ([['group', i[0]] for i in self.groups] +
+                 [['direct', i[0]] for i in self.directs])
+
+        def retrieve(progress, cancel):
+            start = time.time()
+            progress(0, len(chats))
+            results = export_all(token, chats, progress=progress,
+                                 cancel=cancel)
+            return summarize_export(results, time.time() - start)
+
+        self.worker.add("all chats", "chats", retrieve)
+
+    def set_timing(self, checked):
+        """Switch the phase timer on or off for the next retrieval."""
+        phases.enabled = checked
+
+    def stop_retrieval(self):
+        """Cancel the running retrieval and any queued after it."""
+        self.worker.cancel_all()
+        self.status.showMessage("Stopping...")
+
+    def show_progress(self, label, unit, done, total, rate, eta):
+        """Show the progress of the running retrieval."""
+        if done == 0:
+            self.setWindowTitle("Retrieving %s, Please Wait..." % label)
+            if unit == "messages" and eta >= 0:
+                # Show the runtime estimated from past retrievals until
+                # there is a rate to go by.
+                self.get_runtime(eta)
+                return
+
+        message = ("%i of %i %s, %.0f %s/second"
+                   % (done, total, unit, rate, unit))
+        if eta >= 0:
+            message += ", %i:%02i left" % (eta // 60, eta % 60)
+        pending = self.worker.pending()
+        if pending:
+            message += " (%i more queued)" % pending
+        self.status.showMessage(message)
+
+    def finish_job(self, label, message):
+        """Show the outcome of a retrieval."""
+        self.status.showMessage(message)
+        if not self.worker.pending():
+            self.setWindowTitle("Done")
+
+    def get_runtime(self, seconds):
+        """Show the estimated time to retrieve the chat history, as made by
+        a RuntimeEstimator from the throughput of past retrievals.
         """
-        seconds = msg_count/360  # based on tests; 360 messages ~= 1 second
         minutes = seconds/60
         seconds = seconds % 60
 
@@ -489,45 +3430,25 @@ class AppWindow(QtGui.QDialog):
 
         self.status.showMessage(runtime)
 
-    def get_chat(self, token, chat_type, chat_ID, msg_ID=None):
-        """Obtain the requested chat history and store it in a formatted
-        HTML file with CSS.
+    def get_chat(self, token, chat_type, chat_ID, msg_ID=None, label=None):
+        """Queue the retrieval of the requested chat history into a
+        formatted HTML file with CSS. An interrupted retrieval of the chat
+        continues from its last checkpoint.
         """
-        # Obtain the relevant URL.
-        url_general = get_URL(token, chat_type, chat_ID, None)
-        url = get_URL(token, chat_type, chat_ID, msg_ID)
-
-        # Obtain the most recent data set as a starting reference.
-        try:
-            i_json = get_json(url)
-        except urllib2.HTTPError, err:
-            self.status.showMessage("HTTP Error %s. Try again later." % err.code)
-            return
-            
-        msg_count = i_json['response']['count']
-        if msg_count == 0:
-            self.status.showMessage("This chat does not contain any messages.")
-        else:
-            self.setWindowTitle("Retrieving Chat History, Please Wait...")
-            
-            # Estimate the runtime using the number of messages in the chat.
-            self.get_runtime(msg_count)
-
+        def retrieve(progress, cancel):
             # Obtain the user's ID to color the user's name in the chat file.
             self_id = get_self_id(token)
-
-            # Create the chat history file, format it into chronological order,
-            # and create a corresponding CSS file.
-            create_history(i_json, url_general, self_id, chat_type, chat_ID,
-                           msg_count, self.msg_limit, msg_ID)
-            format_history(chat_type, chat_ID, msg_ID)
+            msg_count, stopped = export_chat(token, self_id, chat_type,
+                                             chat_ID, msg_ID=msg_ID,
+                                             progress=progress, cancel=cancel)
+            if msg_count == 0:
+                return "This chat does not contain any messages."
             create_css()
-            
-            # Additional steps are needed if msg_ID is provided. A msg_ID is
-            # provided when repairing/updating chat histories.
-            if not msg_ID:
-                self.status.showMessage("")
-                self.setWindowTitle("Done")
+            if stopped:
+                return "Retrieval stopped. The chat history can be repaired."
+            return ""
+
+        self.worker.add(label or chat_ID, "messages", retrieve)
     
     def select_chat_file(self):
         """Allow the user to select a file which is subsequently written to
@@ -544,121 +3465,56 @@ class AppWindow(QtGui.QDialog):
         and its date. If no errors are found or if the file does not exist, the
         method returns None.
         """
-        try:
-            error_line = ""
-            
-            # Get the line in the chat containing error and chat details.
-            file = open(chat_name)
-            for i, line in enumerate(file):
-                if i == 10: # Error details are recorded in line 11 of file.
-                    error_line = line
-                elif i > 10:
-                    break
-            file.close()
-            error_details = re.search('<p hidden repair>(.*)</p>', error_line)
-            return error_details
-        except:
-            return None
+        return get_error_details(chat_name)
             
     def get_update_details(self, chat_name):
         """Given a chat history file name, return details of the most recent
         message. This includes the chat type and ID and the most recent message
         ID and its date."""
-        try:
-            update_line = ""
-            
-            # Get the line in the chat containing update and chat details.
-            file = open(chat_name)
-            for i, line in enumerate(file):
-                if i == 8: # Update details are recorded in line 11 of file.
-                    update_line = line
-                elif i > 8:
-                    break
-            file.close()
-            update_details = re.search('<p hidden update>(.*)</p>', update_line)
-            return update_details
-        except:
-            return None
+        return get_update_details(chat_name)
     
     def repair_history(self):
         """Repair a chat history file that had its chat retrieval prematurely
         terminated. 
         """
-        chat_original = str(self.file_line.text())
-        error_details = self.get_error_details(chat_original)
-        
-        try:
-            chat_original = open(str(self.file_line.text()), 'r')
-            if not error_details:
-                self.status.showMessage("Are you sure the chat history file is"
-                                        " valid?")
-            else:
-                error_details = error_details.group(1).split()
-                chat_type = error_details[0]
-                chat_ID = error_details[1]
-                last_message_ID = error_details[2]
-                earliest_date = error_details[3:]
-                
-                self.get_chat(self.token_str, chat_type, chat_ID, 
-                              last_message_ID)
-                
-                chat_repair_name = ('%s_%s_chat_history_repair.html'
-                                    % (chat_ID, chat_type))
-                chat_repair = open(chat_repair_name, 'r')
-                
-                # Get the latest message date of the repair chat history file
-                # and compare it to the earliest message date of original
-                # history file. Needed to avoid writing the same date twice.
-                update_details = self.get_update_details(chat_repair_name)
-                update_details = update_details.group(1).split()
-                latest_date = update_details[3:]
-                if latest_date == earliest_date:
-                    date_duplicate = True
-                else:
-                    date_duplicate = False
-                
-                self.merge(chat_ID, chat_type, chat_original, chat_repair, 
-                           date_duplicate)
-                self.status.showMessage("")
-                self.setWindowTitle("Done")
-        except IOError:
-            self.status.showMessage("The file does not exist.")     
-            
-    def update_history(self):
-        # To be written in the future.
-        self.status.showMessage("Chat history updating will be added in the"
-                                " future.")
-        pass
+        token = self.token_str
+        chat_name = str(self.file_line.text())
+        if not os.path.isfile(chat_name):
+            self.status.showMessage("The file does not exist.")
+            return
 
-    def merge(self, chat_ID, chat_type, chat_original, chat_repair, 
-              date_duplicate):
-        """Merge 2 chat histories together."""
-        current_time = time.strftime("%Y%m%d-%H%M%S")
-        chat_fixed = open('%s_%s_chat_history_%s.html'
-                          % (chat_ID, chat_type, current_time), 'w')
-        
-        # Change usage of readlines(). High memory usage.
-        chat_repair_lines = chat_repair.readlines()
-        chat_original_lines = chat_original.readlines()
-        
-        # last 3 lines are HTML lines.
-        chat_fixed.writelines(chat_repair_lines[:-3])
-        
-        # If the date of the latest 'repair messages' is not the same as the
-        # date of the earliest 'original messages', make sure to distinguish
-        # the dates of the those sets of messages.
-        if not date_duplicate:
-            chat_fixed.writelines(chat_original_lines[8])
-            
-        # chat messages start at line 12.
-        chat_fixed.writelines(chat_original_lines[11:])
-        
-        chat_fixed.close()
-        chat_original.close()
-        chat_repair.close()
+        def repair(progress, cancel):
+            try:
+                self_id = get_self_id(token)
+                repair_chat(token, self_id, chat_name, progress, cancel)
+            except ValueError:
+                return "Are you sure the chat history file is valid?"
+            return ""
 
-        os.remove(str(self.file_line.text()))
-        os.remove('%s_%s_chat_history_repair.html' % (chat_ID, chat_type))
+        self.worker.add(os.path.basename(chat_name), "messages", repair)
+
+    def update_history(self):
+        """Add the messages sent since a chat history file was retrieved to
+        the file.
+        """
+        token = self.token_str
+        chat_name = str(self.file_line.text())
+        if not os.path.isfile(chat_name):
+            self.status.showMessage("The file does not exist.")
+            return
+
+        def update(progress, cancel):
+            archive = open_archive()
+            try:
+                self_id = get_self_id(token)
+                msg_count = update_chat(token, self_id, chat_name, archive)
+            except ValueError:
+                return "Are you sure the chat history file is valid?"
+            finally:
+                archive.close()
+            return "%i new messages added." % msg_count
+
+        self.worker.add(os.path.basename(chat_name), "messages", update)
         
 if __name__ == '__main__':
     app = QtGui.QApplication(sys.argv)
@@ -0,0 +1,737 @@
+"""Benchmarks for the chat history retrieval pipeline.
+
+Each benchmark runs against the local stand-in server in 'mock_server.py'
+or against generated fixtures, so no access token is needed. Run one by
+name, e.g.
+
+    python benchmark.py pool
+"""
+import sys
+import os
+import time
+import imp
+import shutil
+import tempfile
+import threading
+import resource
+import random
+import urllib2
+from json import load, dumps
+from StringIO import StringIO
+
+from mock_server import MockServer, make_messages, start_time
+
+app = imp.load_source('get_chat_history', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..',
+    'get_chat_history_v1.1.py'))
+
+# Only the 'limiter' benchmark is meant to be held back by the rate limiter.
+unlimited = app.RateLimiter(1e9, 1e9)
+app.limiter = unlimited
+
+
+def report(name, count, unit, seconds):
+    print '%-24s %8i %s in %6.2fs  %10.1f %s/s' % (
+        name, count, unit, seconds, count / seconds, unit)
+
+
+def bench_pool(pages=500):
+    """Compare pages/second with and without the keep-alive pool."""
+    server = MockServer(msg_count=pages * app.message_limit).start()
+    url = '%s/groups/1/messages?token=x&limit=%i' % (server.url,
+                                                     app.message_limit)
+
+    start = time.time()
+    for i in range(pages):
+        load(urllib2.urlopen(url))
+    report('urllib2.urlopen', pages, 'pages', time.time() - start)
+
+    start = time.time()
+    for i in range(pages):
+        app.get_json(url)
+    report('ConnectionPool', pages, 'pages', time.time() - start)
+
+    app.pool.close()
+    server.shutdown()
+
+
+def bench_parse(pages=2000):
+    """Compare messages/second of indexing decoded pages and reading them
+    into records.
+    """
+    limit = app.message_limit
+    count = pages * limit
+    messages = make_messages(count)
+    fixtures = []
+    for i in range(pages):
+        page = messages[i * limit:(i + 1) * limit][::-1]
+        fixtures.append(dumps({'response': {'count': count,
+                                            'messages': page}}))
+
+    start = time.time()
+    for fixture in fixtures:
+        json = load(StringIO(fixture))
+        messages = json['response']['messages']
+        for i in range(len(messages)):
+            (messages[i]['created_at'], messages[i]['user_id'],
+             messages[i]['name'], messages[i]['text'], messages[i]['id'],
+             messages[i]['attachments'], messages[i]['favorited_by'])
+    report('json.load', count, 'msgs', time.time() - start)
+
+    start = time.time()
+    for fixture in fixtures:
+        app.read_page(StringIO(fixture))
+    report('read_page', count, 'msgs', time.time() - start)
+
+
+def bench_history(pages=100, latency=0.02):
+    """Time fetching and writing a chat with create_history.
+
+    Without the background page fetcher, create_history takes about as long
+    as fetching every page plus writing every page; with it, the two overlap.
+    Each is timed on its own against a server with 'latency' seconds per
+    page, then create_history is timed as a whole.
+    """
+    limit = app.message_limit
+    count = pages * limit
+    server = MockServer(msg_count=count).start()
+    url = '%s/groups/1/messages?token=x&limit=%i' % (server.url, limit)
+
+    cwd = os.getcwd()
+    tmp = tempfile.mkdtemp()
+    os.chdir(tmp)
+    try:
+        # Writing only: pages arrive as fast as the local server serves them.
+        start = time.time()
+        app.create_history(app.get_json(url), url, '1000', 'group', '1',
+                           count, limit, None)
+        report('writing', count, 'msgs', time.time() - start)
+
+        server.latency = latency
+
+        # Fetching only.
+        start = time.time()
+        page = app.get_page(url)
+        for i in range(pages - 1):
+            page = app.get_page('%s&before_id=%s' % (url, page[-1][4]))
+        report('fetching', count, 'msgs', time.time() - start)
+
+        start = time.time()
+        app.create_history(app.get_json(url), url, '1000', 'group', '1',
+                           count, limit, None)
+        report('create_history', count, 'msgs', time.time() - start)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp)
+        app.pool.close()
+        server.shutdown()
+
+
+def bench_limiter(pages=200, workers=4, rate_limit=40):
+    """Fetch pages from 'workers' threads at once through the rate limiter,
+    against a server that throttles above 'rate_limit' requests/second.
+    """
+    limit = app.message_limit
+    server = MockServer(msg_count=limit, rate_limit=rate_limit).start()
+    url = '%s/groups/1/messages?token=x&limit=%i' % (server.url, limit)
+    app.limiter = app.RateLimiter(app.request_rate, app.max_request_rate)
+    failed = []
+
+    def fetch():
+        for i in range(pages / workers):
+            try:
+                app.get_page(url)
+            except urllib2.HTTPError:
+                failed.append(i)
+
+    threads = [threading.Thread(target=fetch) for i in range(workers)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    report('RateLimiter', pages, 'pages', time.time() - start)
+    print '%i requests throttled, %i pages failed, final rate %.1f/s' % (
+        server.throttle_count, len(failed), app.limiter.rate)
+
+    app.limiter = unlimited
+    app.pool.close()
+    server.shutdown()
+
+
+def bench_clock(msg_count=100000):
+    """Compare messages/second of formatting message times with strftime()
+    and with LocalClock.
+    """
+    times = [message['created_at'] for message in make_messages(msg_count)]
+
+    start = time.time()
+    old_date = None
+    for epoch_time in times:
+        date = time.strftime('%A, %d %B %Y', time.localtime(epoch_time))
+        hour = time.strftime('%H:%M:%S', time.localtime(epoch_time))
+        if date != old_date:
+            old_date = date
+    report('strftime', msg_count, 'msgs', time.time() - start)
+
+    start = time.time()
+    clock = app.LocalClock()
+    old_day = None
+    for epoch_time in times:
+        day, date, hour = clock.format(epoch_time)
+        if day != old_day:
+            old_day = day
+    report('LocalClock', msg_count, 'msgs', time.time() - start)
+
+
+def write_syscalls():
+    """Return the number of write system calls made by this process (Linux)."""
+    with open('/proc/self/io') as f:
+        for line in f:
+            if line.startswith('syscw:'):
+                return int(line.split()[1])
+
+
+def bench_rows(msg_count=200000):
+    """Compare messages/second and write system calls of writing a history
+    one row at a time and a page at a time with render_page().
+    """
+    limit = app.message_limit
+    messages = make_messages(msg_count)[::-1]
+    for i, message in enumerate(messages):
+        message['name'] = u'User \u00e9 %i' % (i % 5)
+    page = [app.get_record(message) for message in messages]
+    pages = [page[i:i + limit] for i in range(0, msg_count, limit)]
+
+    cwd = os.getcwd()
+    tmp = tempfile.mkdtemp()
+    os.chdir(tmp)
+    try:
+        # One row at a time, as create_history used to.
+        calls = write_syscalls()
+        start = time.time()
+        f = open('rows.txt', 'wb')
+        old_date = None
+        for page in pages:
+            for (epoch_time, user_id, name, text, msg_id, attachments,
+                 likes) in page:
+                local = time.localtime(epoch_time)
+                date = time.strftime('%A, %d %B %Y', local)
+                hour = time.strftime('%H:%M:%S', local)
+                if date != old_date:
+                    f.write(app.date_row % old_date)
+                    old_date = date
+                f.write(app.format_message(hour, user_id, name, text,
+                                           '1000'))
+        f.close()
+        report('per row', msg_count, 'msgs', time.time() - start)
+        print '%-24s %i write syscalls, %i bytes' % (
+            '', write_syscalls() - calls, os.path.getsize('rows.txt'))
+
+        calls = write_syscalls()
+        start = time.time()
+        f = open('pages.txt', 'wb', app.output_buffer)
+        clock = app.LocalClock()
+        old_day = old_date = None
+        for page in pages:
+            data, old_day, old_date = app.render_page(page, '1000', clock,
+                                                      old_day, old_date)
+            f.write(data)
+        f.close()
+        report('render_page', msg_count, 'msgs', time.time() - start)
+        print '%-24s %i write syscalls, %i bytes' % (
+            '', write_syscalls() - calls, os.path.getsize('pages.txt'))
+
+        assert open('rows.txt').read() == open('pages.txt').read()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp)
+
+
+def bench_escape(msg_count=100000):
+    """Compare messages/second and output size of formatting rows with
+    unicode-escape and with escape_html(), on emoji-heavy and CJK-heavy
+    fixtures.
+    """
+    fixtures = [
+        ('emoji', u'ok \U0001f602\U0001f602 see you at 8 \U0001f44d\U0001f389 '
+                  u'<3 \u2764\ufe0f\n\U0001f600 %i'),
+        ('CJK', u'\u4eca\u65e5\u306f\u3044\u3044\u5929\u6c17\u3067\u3059\u306d'
+                u'\u3002\u660e\u65e5\u4f1a\u3044\u307e\u3057\u3087\u3046 & '
+                u'\u4f60\u597d %i'),
+    ]
+    for name, text in fixtures:
+        texts = [text % i for i in range(msg_count)]
+
+        start = time.time()
+        size = 0
+        for text in texts:
+            text = text.encode('unicode-escape')
+            size += len((app.other_row % (u'User', '12:34:56', text))
+                        .encode('UTF-8'))
+        report('%s unicode-escape' % name, msg_count, 'msgs',
+               time.time() - start)
+        print '%-24s %i bytes' % ('', size)
+
+        start = time.time()
+        size = 0
+        for text in texts:
+            size += len(app.format_row('12:34:56', '1', u'User', text, '0')
+                        .encode('UTF-8'))
+        report('%s escape_html' % name, msg_count, 'msgs',
+               time.time() - start)
+        print '%-24s %i bytes' % ('', size)
+
+
+def peak_rss():
+    """Return the peak resident memory of this process in MB (Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def bench_format(msg_count=500000):
+    """Compare time and peak memory of reversing a history with readlines()
+    and with reverse_lines().
+
+    reverse_lines() runs first; peak RSS only ever grows, so each line shows
+    how far that run pushed it.
+    """
+    cwd = os.getcwd()
+    tmp = tempfile.mkdtemp()
+    os.chdir(tmp)
+    try:
+        line = ('<tr><td class="name">User 1</td> <td class="hour">(12:34:56):'
+                '</td> <td class="text">message number %i</td></tr>\n')
+        with open('1_chat_history.txt', 'wb') as f:
+            for i in range(msg_count):
+                f.write(line % i)
+        temp_bytes = os.path.getsize('1_chat_history.txt')
+
+        rss = peak_rss()
+        start = time.time()
+        with open('1_chat_history.txt', 'rb') as f:
+            with open('reverse_lines.html', 'w') as final:
+                for line in app.reverse_lines(f):
+                    final.write(line)
+        seconds = time.time() - start
+        report('reverse_lines', msg_count, 'lines', seconds)
+        print '%-24s peak RSS +%.1f MB, %i bytes read, %i bytes written' % (
+            '', peak_rss() - rss, temp_bytes,
+            os.path.getsize('reverse_lines.html'))
+
+        rss = peak_rss()
+        start = time.time()
+        with open('1_chat_history.txt', 'r') as f:
+            with open('readlines.html', 'w') as final:
+                for line in reversed(f.readlines()):
+                    final.write(line)
+        seconds = time.time() - start
+        report('readlines', msg_count, 'lines', seconds)
+        print '%-24s peak RSS +%.1f MB, %i bytes read, %i bytes written' % (
+            '', peak_rss() - rss, temp_bytes,
+            os.path.getsize('readlines.html'))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp)
+
+
+def bench_volumes(msg_count=1000000, per_day=200):
+    """Compare messages/second of writing a history as one file with
+    format_history() and as monthly volumes with format_volumes(), and the
+    size of the largest file a browser has to open.
+    """
+    cwd = os.getcwd()
+    tmp = tempfile.mkdtemp()
+    os.chdir(tmp)
+    try:
+        line = ('<tr><td class="name">User 1</td> <td class="hour">(12:34:56):'
+                '</td> <td class="text">message number %i</td></tr>\n')
+        day = 86400
+        with open('1_chat_history.txt', 'wb') as f:
+            for i in range(msg_count, 0, -1):
+                f.write(line % i)
+                if i % per_day == 1:
+                    date = time.strftime('%A, %d %B %Y',
+                                         time.gmtime(i / per_day * day))
+                    f.write(app.date_row % date)
+
+        start = time.time()
+        index = app.format_volumes('group', '1', 'month')
+        report('format_volumes', msg_count, 'msgs', time.time() - start)
+        directory = os.path.dirname(index)
+        sizes = [os.path.getsize(os.path.join(directory, name))
+                 for name in os.listdir(directory)]
+        print '%-24s %i files, largest %i bytes' % ('', len(sizes),
+                                                    max(sizes))
+
+        start = time.time()
+        app.format_history('group', '1', None)
+        report('format_history', msg_count, 'msgs', time.time() - start)
+        name = [name for name in os.listdir('.') if name.endswith('.html')]
+        print '%-24s 1 file, %i bytes' % ('', os.path.getsize(name[0]))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp)
+
+
+def bench_search(msg_count=500000, vocabulary=20000):
+    """Time storing messages in the archive with the text index kept up to
+    date, and searching them with keyword, phrase and filtered queries.
+    """
+    limit = app.message_limit
+    rand = random.Random(0)
+    words = ['word%i' % i for i in range(vocabulary)]
+    messages = make_messages(msg_count)
+    for message in messages:
+        # Zipf-like word frequencies, as in real chats.
+        message['text'] = ' '.join(
+            words[int(vocabulary ** rand.random()) - 1]
+            for i in range(rand.randint(3, 15)))
+    records = [app.get_record(message) for message in messages]
+
+    cwd = os.getcwd()
+    tmp = tempfile.mkdtemp()
+    os.chdir(tmp)
+    try:
+        archive = app.open_archive()
+        start = time.time()
+        for i in range(0, msg_count, limit):
+            app.store_page(archive, 'group', '1', records[i:i + limit])
+        archive.commit()
+        report('store_page', msg_count, 'msgs', time.time() - start)
+        print '%-24s archive %i bytes' % ('', os.path.getsize(
+            app.archive_name))
+
+        middle = start_time + msg_count / 2 * 97
+        queries = [
+            ('common word', ('word0',), {}),
+            ('rare word', ('word15000',), {}),
+            ('two words', ('word3 word7',), {}),
+            ('phrase', ('"word1 word2"',), {}),
+            ('prefix', ('word123*',), {}),
+            ('sender and dates', ('word5',),
+             {'sender': 'User 3', 'since': middle,
+              'until': middle + 86400 * 7}),
+        ]
+        for name, args, kwargs in queries:
+            start = time.time()
+            for i in range(10):
+                results = app.search_archive(archive, *args, **kwargs)
+            print '%-24s %8.2f ms  %i results' % (
+                name, (time.time() - start) * 100, len(results))
+        archive.close()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp)
+
+
+def bench_render(msg_count=500000):
+    """Time storing a chat in the archive and rendering it back to HTML,
+    JSON Lines and CSV.
+    """
+    limit = app.message_limit
+    messages = make_messages(msg_count)
+    records = [app.get_record(message) for message in messages]
+
+    cwd = os.getcwd()
+    tmp = tempfile.mkdtemp()
+    os.chdir(tmp)
+    try:
+        archive = app.open_archive()
+        start = time.time()
+        for i in range(0, msg_count, limit):
+            app.store_page(archive, 'group', '1', records[i:i + limit])
+        archive.commit()
+        report('store_page', msg_count, 'msgs', time.time() - start)
+
+        start = time.time()
+        app.render_history(archive, '1000', 'group', '1')
+        report('render_history', msg_count, 'msgs', time.time() - start)
+
+        for file_format in ('jsonl', 'csv'):
+            start = time.time()
+            name = app.export_records(archive, 'group', '1', file_format)
+            report('export_records %s' % file_format, msg_count, 'msgs',
+                   time.time() - start)
+            print '%-24s %i bytes' % ('', os.path.getsize(name))
+        archive.close()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp)
+
+
+def bench_merge(msg_count=500000):
+    """Compare time and peak memory of merging a chat history with its
+    repair file with readlines() and with merge_histories().
+
+    merge_histories() runs first; see bench_format().
+    """
+    cwd = os.getcwd()
+    tmp = tempfile.mkdtemp()
+    os.chdir(tmp)
+    try:
+        day = 'Thursday, 11 September 2014'
+        date = '<tr><td class="date" colspan="3">%s</td></tr>\n' % day
+        update = app.format_update_details('group', '1', '1', day)
+        line = ('<tr><td class="name">User 1</td> <td class="hour">(12:34:56):'
+                '</td> <td class="text">message number %i</td></tr>\n')
+        with open('original.html', 'wb') as f:
+            f.write(app.html_header + date + update + '<h1>ERROR</h1>\n' +
+                    '<p hidden repair>group 1 1 %s</p>\n' % day)
+            for i in range(msg_count / 2):
+                f.write(line % i)
+            f.write(app.html_footer)
+        with open('repair.html', 'wb') as f:
+            f.write(app.html_header + date + update)
+            for i in range(msg_count / 2):
+                f.write(line % i)
+            f.write(app.html_footer)
+        read_bytes = (os.path.getsize('original.html') +
+                      os.path.getsize('repair.html'))
+
+        rss = peak_rss()
+        start = time.time()
+        with open('original.html', 'rb') as original:
+            with open('repair.html', 'rb') as repair:
+                with open('merge_histories.html', 'wb') as fixed:
+                    app.merge_histories(original, repair, fixed, False)
+        report('merge_histories', msg_count, 'msgs', time.time() - start)
+        print '%-24s peak RSS +%.1f MB, %i bytes read, %i bytes written' % (
+            '', peak_rss() - rss, read_bytes,
+            os.path.getsize('merge_histories.html'))
+
+        rss = peak_rss()
+        start = time.time()
+        with open('original.html', 'r') as original:
+            with open('repair.html', 'r') as repair:
+                with open('readlines.html', 'w') as fixed:
+                    repair_lines = repair.readlines()
+                    original_lines = original.readlines()
+                    fixed.writelines(repair_lines[:-3])
+                    fixed.writelines(original_lines[7])
+                    fixed.writelines(original_lines[11:])
+        report('readlines', msg_count, 'msgs', time.time() - start)
+        print '%-24s peak RSS +%.1f MB, %i bytes read, %i bytes written' % (
+            '', peak_rss() - rss, read_bytes,
+            os.path.getsize('readlines.html'))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp)
+
+
+def bench_compress(msg_count=1000000):
+    """Compare messages/second and file size of writing a history with
+    format_history() uncompressed, with gzip and with zstd, and of reading
+    it back, on the example history's messages scaled up.
+    """
+    example = open(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'example',
+                                '01234567_group_chat_history.html'), 'rb')
+    rows = [line.replace('</td></tr>', ' %i</td></tr>')
+            for line in example.read().splitlines(True)
+            if line.startswith('<tr>') and 'class="date"' not in line]
+    example.close()
+    rows = [rows[i % len(rows)] % i for i in range(msg_count)]
+
+    cwd = os.getcwd()
+    tmp = tempfile.mkdtemp()
+    os.chdir(tmp)
+    try:
+        plain_size = None
+        for compression in (None, 'gzip', 'zstd'):
+            if compression == 'zstd' and not app.zstandard:
+                print '%-24s zstandard is not installed' % 'zstd'
+                continue
+            with open('1_chat_history.txt', 'wb') as f:
+                f.writelines(rows)
+
+            start = time.time()
+            app.format_history('group', '1', None, compression)
+            report('write %s' % compression, msg_count, 'msgs',
+                   time.time() - start)
+            name = os.listdir('.')[0]
+            size = os.path.getsize(name)
+            plain_size = plain_size or size
+            print '%-24s %i bytes, ratio %.1f' % ('', size,
+                                                  plain_size / float(size))
+
+            start = time.time()
+            f = app.open_history(name)
+            while f.read(app.block_size):
+                pass
+            f.close()
+            report('read %s' % compression, msg_count, 'msgs',
+                   time.time() - start)
+            os.remove(name)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp)
+
+
+def bench_phases(calls=1000000, msg_count=20000):
+    """Time the phase timer's start() and add() disabled and enabled, then
+    export a chat from the mock server with the breakdown printed.
+    """
+    timer = app.PhaseTimer()
+    for enabled in (False, True):
+        timer.enabled = enabled
+        start = time.time()
+        for i in range(calls):
+            timer.add('phase', timer.start(), 100)
+        report('PhaseTimer %s' % ('on' if enabled else 'off'), calls,
+               'calls', time.time() - start)
+
+    server = MockServer(msg_count=msg_count).start()
+    cwd = os.getcwd()
+    tmp = tempfile.mkdtemp()
+    os.chdir(tmp)
+    api_url = app.api_url
+    app.api_url = server.url
+    app.phases.enabled = True
+    try:
+        app.run_profiled(app.export_chat, 'x', '1000', 'group', '1',
+                         ('html', 'jsonl'))
+    finally:
+        app.phases.enabled = False
+        app.api_url = api_url
+        os.chdir(cwd)
+        shutil.rmtree(tmp)
+        app.pool.close()
+        server.shutdown()
+
+
+def bench_cache(lookups=100, groups=50, directs=50):
+    """Time looking up the user's ID and chat lists 'lookups' times each,
+    with the account cache invalidated before every lookup and kept.
+    """
+    server = MockServer(msg_count=1, groups=groups, directs=directs).start()
+    api_url = app.api_url
+    app.api_url = server.url
+    try:
+        for cached in (False, True):
+            app.account_cache.invalidate()
+            requests = server.request_count
+            start = time.time()
+            for i in range(lookups):
+                if not cached:
+                    app.account_cache.invalidate('x')
+                app.get_self_id('x')
+                app.get_groups('x')
+                app.get_directs('x')
+            report('lookups %s' % ('cached' if cached else 'uncached'),
+                   lookups * 3, 'lookups', time.time() - start)
+            print '%-24s %i requests' % ('', server.request_count - requests)
+    finally:
+        app.account_cache.invalidate()
+        app.api_url = api_url
+        app.pool.close()
+        server.shutdown()
+
+
+def bench_media(chats=4, msg_count=5000, latency=0.005, image_count=100):
+    """Time exporting every chat of a mock account with export_all(), with
+    and without attachments downloaded, and count the files stored. Every
+    tenth message has an image, and images repeat across chats.
+    """
+    server = MockServer(msg_count=msg_count, latency=latency, groups=chats,
+                        image_count=image_count).start()
+    cwd = os.getcwd()
+    tmp = tempfile.mkdtemp()
+    os.chdir(tmp)
+    api_url = app.api_url
+    app.api_url = server.url
+    chats = [['group', str(i + 1)] for i in range(chats)]
+    try:
+        for download_media in (False, True):
+            app.download_media = download_media
+            start = time.time()
+            results = app.export_all('x', chats)
+            report('export_all media %s' % ('on' if download_media
+                                              else 'off'),
+                   sum(result[2] for result in results), 'msgs',
+                   time.time() - start)
+        files = [name for directory, names, files in os.walk('media')
+                 for name in files if name != 'index.json']
+        linked = sum(open(name).read().count('href="media/')
+                     for name in os.listdir('.') if name.endswith('.html'))
+        print '%-24s %i images requested, %i files stored, %i links local' % (
+            '', server.image_requests, len(files), linked)
+    finally:
+        app.download_media = False
+        app.api_url = api_url
+        os.chdir(cwd)
+        shutil.rmtree(tmp)
+        app.pool.close()
+        server.shutdown()
+
+
+def bench_faults(groups=4, directs=4, msg_count=2000, latency=0.01,
+                 fault_rate=0.02):
+    """Time exporting every chat of a mock account with export_all(), first
+    against a healthy server, then against one that fails, cuts off and
+    resets 'fault_rate' of requests each, and report the requests made.
+
+    The application is pointed at the server through 'api_url', so chats
+    are listed and retrieved exactly as they are from GroupMe.
+    """
+    cwd = os.getcwd()
+    tmp = tempfile.mkdtemp()
+    os.chdir(tmp)
+    api_url = app.api_url
+    backoff_base = app.backoff_base
+    app.backoff_base = 0.01
+    try:
+        for rate in (0, fault_rate):
+            server = MockServer(msg_count=msg_count, latency=latency,
+                                groups=groups, directs=directs,
+                                error_rate=rate, truncate_rate=rate,
+                                reset_rate=rate, seed=0).start()
+            app.api_url = server.url
+            app.metrics.reset()
+            chats = ([['group', i[0]] for i in app.get_groups('x')] +
+                     [['direct', i[0]] for i in app.get_directs('x')])
+
+            start = time.time()
+            results = app.export_all('x', chats)
+            seconds = time.time() - start
+            msgs = sum(result[2] for result in results)
+            report('export_all faults %.2f' % rate, msgs, 'msgs', seconds)
+            print '%-24s %i requests, faults %s, failed chats %i' % (
+                '', server.request_count, server.fault_counts,
+                len([result for result in results if result[3]]))
+            print app.metrics.report()
+
+            app.pool.close()
+            server.shutdown()
+            for name in os.listdir('.'):
+                os.remove(name)
+    finally:
+        app.api_url = api_url
+        app.backoff_base = backoff_base
+        os.chdir(cwd)
+        shutil.rmtree(tmp)
+
+
+benchmarks = {
+    'cache': bench_cache,
+    'clock': bench_clock,
+    'compress': bench_compress,
+    'escape': bench_escape,
+    'faults': bench_faults,
+    'format': bench_format,
+    'history': bench_history,
+    'limiter': bench_limiter,
+    'media': bench_media,
+    'merge': bench_merge,
+    'parse': bench_parse,
+    'phases': bench_phases,
+    'pool': bench_pool,
+    'render': bench_render,
+    'rows': bench_rows,
+    'search': bench_search,
+    'volumes': bench_volumes,
+}
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or sorted(benchmarks)
+    for name in names:
+        benchmarks[name]()
@@ -0,0 +1,439 @@
+"""A local stand-in for GroupMe's API, used for benchmarking and testing.
+
+The server holds synthetic group and direct message chats and serves them
+the way GroupMe does:
+
+    /v3/users/me                  the user the token belongs to
+    /v3/groups                    group chats, paged with 'page'/'per_page'
+    /v3/chats                     direct message chats, paged the same way
+    /v3/groups/:id/messages       a group chat's messages
+    /v3/direct_messages           a direct message chat's messages, chosen
+                                  with 'other_user_id'
+    /images/:n.jpeg               an attachment, standing in for GroupMe's
+                                  image service
+
+Messages are served newest first, at most 'limit' (up to 100) per page,
+paged back with 'before_id'. Group chats can also be paged forwards with
+'after_id', which serves the messages right after it, oldest first. A page
+with no messages is answered with 304 and an unknown chat with 404.
+
+Every tenth message has an image attachment. Only 'image_count' images
+differ; the rest repeat them under new URLs, as images reposted in other
+messages and chats do.
+
+Given a rate limit, the server throttles like GroupMe does, answering 420
+to any request over the limit. The limit is a token bucket of 'burst'
+requests refilled at 'rate_limit' requests per second, so a client is
+throttled exactly when it goes over that rate.
+
+Faults can be injected into a fraction of requests: errors (420 or 5xx),
+responses whose body is cut off partway, and connections reset without an
+answer. Faults are drawn from a random generator seeded with 'seed', so
+a run can be repeated exactly.
+
+Run it directly to serve on a port of your choice:
+
+    python mock_server.py 8000 10000 --groups 3 --directs 2 --errors 0.05
+
+which serves three group chats and two direct message chats of 10000
+messages each at http://127.0.0.1:8000/v3, failing 5% of requests. Point
+the application at it by setting its 'api_url' to that address.
+"""
+import sys
+import time
+import json
+import random
+import socket
+import struct
+import re
+import threading
+import argparse
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+start_time = 1410353613  # Wednesday, 10 September 2014
+first_id = 100000000000000000  # ID of the first message of the first chat.
+self_id = '1000'  # ID of the user every token belongs to.
+
+# Codes answered by injected errors: throttling and server failures.
+error_codes = (420, 500, 502, 503)
+
+
+def make_messages(msg_count, first_id=first_id,
+                  image_url='https://i.groupme.com'):
+    """Return a list of synthetic messages, oldest first. Attachments are
+    images at 'image_url'.
+    """
+    messages = []
+    for i in range(msg_count):
+        messages.append({
+            'id': str(first_id + i),
+            'created_at': start_time + i * 97,
+            'user_id': str(1000 + i % 5),
+            'name': 'User %i' % (i % 5),
+            'text': 'message number %i' % i,
+            'attachments': ([{'type': 'image',
+                              'url': '%s/%i.jpeg' % (image_url,
+                                                     (first_id + i) // 10)}]
+                            if i % 10 == 0 else []),
+            'favorited_by': [str(1000 + j) for j in range(i % 3)],
+        })
+
+    return messages
+
+
+def make_image(n, size):
+    """Return the contents of synthetic image 'n', 'size' bytes long."""
+    data = ('image %i ' % n) * (size // 8 + 1)
+
+    return data[:size]
+
+
+class Chat(object):
+    """A synthetic chat: its messages, oldest first, and an index of their
+    positions by ID.
+    """
+
+    def __init__(self, chat_ID, name, msg_count, first_id, image_url):
+        self.id = chat_ID
+        self.name = name
+        self.messages = make_messages(msg_count, first_id, image_url)
+        self.index = dict((m['id'], i) for i, m in enumerate(self.messages))
+
+
+class MockHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answer GroupMe API requests from the server's synthetic chats."""
+    protocol_version = 'HTTP/1.1'  # keep connections alive
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.dropped = False
+        with self.server.lock:
+            self.server.handlers[threading.current_thread()] = self.connection
+
+    def handle(self):
+        # A client may reset a kept-alive connection instead of closing it,
+        # as the application's pool does when it exits.
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.handle(self)
+        except socket.error:
+            self.dropped = True
+
+    def finish(self):
+        with self.server.lock:
+            self.server.handlers.pop(threading.current_thread(), None)
+        # A reset connection is already closed; flushing it would write to
+        # a closed socket.
+        if not self.dropped:
+            BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, truncate=False):
+        data = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if truncate:
+            # Promise the whole body but send only half of it.
+            self.wfile.write(data[:len(data) // 2])
+            self.close_connection = 1
+        else:
+            self.wfile.write(data)
+
+    def send_empty(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def reset(self):
+        """Drop the connection without an answer. Closing with a zero
+        linger time makes the client see a reset, not an orderly close.
+        """
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                   struct.pack('ii', 1, 0))
+        self.close_connection = 1
+        self.dropped = True
+        self.connection.close()
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.request_count += 1
+        if self.server.throttle():
+            self.send_empty(420)
+            return
+
+        fault = self.server.draw_fault()
+        if fault == 'reset':
+            self.reset()
+            return
+        if fault == 'error':
+            self.send_empty(self.server.random.choice(error_codes))
+            return
+
+        parts = urlparse.urlsplit(self.path)
+        query = dict(urlparse.parse_qsl(parts.query))
+        match = re.match(r'^/v3/groups/([^/]+)/messages$', parts.path)
+        image = re.match(r'^/images/(\d+)\.jpeg$', parts.path)
+        truncate = fault == 'truncate'
+
+        if image:
+            self.send_image(int(image.group(1)), truncate)
+        elif parts.path == '/v3/users/me':
+            self.send_json(200, {'response': {'user_id': self_id,
+                                              'id': self_id,
+                                              'name': 'Mock User'}},
+                           truncate)
+        elif parts.path == '/v3/groups':
+            self.send_list(query, 500, truncate, [
+                {'id': chat.id, 'name': chat.name,
+                 'messages': {'count': len(chat.messages)}}
+                for chat in self.server.groups])
+        elif parts.path == '/v3/chats':
+            self.send_list(query, 100, truncate, [
+                {'other_user': {'id': chat.id, 'name': chat.name},
+                 'messages_count': len(chat.messages)}
+                for chat in self.server.directs])
+        elif match:
+            self.send_messages(self.server.find_chat('group', match.group(1)),
+                               'messages', query, truncate)
+        elif parts.path == '/v3/direct_messages':
+            chat = self.server.find_chat('direct',
+                                         query.get('other_user_id'))
+            self.send_messages(chat, 'direct_messages', query, truncate)
+        else:
+            self.send_empty(404)
+
+    def send_image(self, n, truncate):
+        self.server.wait()
+        with self.server.lock:
+            self.server.image_requests += 1
+        data = make_image(n % self.server.image_count, self.server.image_size)
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if truncate:
+            self.wfile.write(data[:len(data) // 2])
+            self.close_connection = 1
+        else:
+            self.wfile.write(data)
+
+    def send_list(self, query, max_per_page, truncate, chats):
+        """Send one page of a list of chats, as /groups and /chats do."""
+        page = max(1, int(query.get('page', 1)))
+        per_page = min(max_per_page, int(query.get('per_page', 10)))
+
+        start = (page - 1) * per_page
+        self.send_json(200, {'response': chats[start:start + per_page]},
+                       truncate)
+
+    def send_messages(self, chat, key, query, truncate):
+        if chat is None:
+            self.send_empty(404)
+            return
+        self.server.wait()
+        messages = chat.messages
+        limit = min(100, int(query.get('limit', 20)))
+
+        if 'before_id' in query:
+            end = chat.index.get(query['before_id'], 0)
+            page = messages[max(0, end - limit):end][::-1]
+        elif 'after_id' in query and key == 'messages':
+            start = chat.index.get(query['after_id'], len(messages)) + 1
+            page = messages[start:start + limit]
+        else:
+            page = messages[-limit:][::-1]
+        if not page:
+            self.send_empty(304)
+            return
+
+        self.send_json(200, {'response': {'count': len(messages),
+                                          key: page}}, truncate)
+
+
+class MockServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A threaded HTTP server serving synthetic chats.
+
+    There are 'groups' group chats, with IDs '1', '2', ..., and 'directs'
+    direct message chats, with other user IDs '2001', '2002', .... Each has
+    'msg_count' messages, or as many as given for it in 'chat_sizes', a
+    list of sizes for the group chats followed by the direct message chats.
+
+    Images are 'image_size' bytes, and there are 'image_count' different
+    ones; 'image_requests' counts the requests for them. Attachments link
+    to this server's images unless another 'image_url' is given, such as
+    the /images of a second server standing in for a separate image host.
+
+    Each page of messages and each image is delayed by 'latency' seconds,
+    plus up to 'jitter' seconds more at random, to stand in for the round
+    trip to GroupMe. Requests over 'rate_limit' per second are throttled;
+    None means no limit. 'error_rate', 'truncate_rate' and 'reset_rate' are the
+    fractions of requests that fail, have their page cut off, and have
+    their connection reset; 'fault_counts' counts each as it happens.
+    """
+    daemon_threads = True
+
+    def __init__(self, port=0, msg_count=1000, latency=0, rate_limit=None,
+                 burst=5, groups=1, directs=0, chat_sizes=None, jitter=0,
+                 error_rate=0, truncate_rate=0, reset_rate=0, seed=None,
+                 image_count=50, image_size=20000, image_url=None):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port),
+                                           MockHandler)
+        if not image_url:
+            image_url = 'http://127.0.0.1:%i/images' % self.server_address[1]
+        sizes = list(chat_sizes or [])
+        sizes += [msg_count] * (groups + directs - len(sizes))
+        next_id = first_id
+        self.groups = []
+        self.directs = []
+        for i, size in enumerate(sizes[:groups + directs]):
+            if i < groups:
+                chat = Chat(str(i + 1), 'Group %i' % (i + 1), size, next_id,
+                            image_url)
+                self.groups.append(chat)
+            else:
+                n = i - groups + 1
+                chat = Chat(str(2000 + n), 'Friend %i' % n, size, next_id,
+                            image_url)
+                self.directs.append(chat)
+            next_id += size
+
+        # The first chat, kept for benchmarks of a single chat.
+        chats = self.groups + self.directs
+        if chats:
+            self.messages = chats[0].messages
+            self.index = chats[0].index
+
+        self.image_count = image_count
+        self.image_size = image_size
+        self.image_requests = 0
+        self.request_count = 0
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.burst = burst
+        self.allowance = burst
+        self.checked = time.time()
+        self.throttle_count = 0
+        self.error_rate = error_rate
+        self.truncate_rate = truncate_rate
+        self.reset_rate = reset_rate
+        self.fault_counts = {'error': 0, 'truncate': 0, 'reset': 0}
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.handlers = {}  # thread -> connection of each open connection
+
+    def find_chat(self, chat_type, chat_ID):
+        """Return the chat of the given type and ID, or None."""
+        chats = self.groups if chat_type == 'group' else self.directs
+        for chat in chats:
+            if chat.id == chat_ID:
+                return chat
+
+        return None
+
+    def wait(self):
+        """Sleep for the latency of a page of messages."""
+        with self.lock:
+            jitter = self.random.uniform(0, self.jitter)
+        if self.latency or jitter:
+            time.sleep(self.latency + jitter)
+
+    def draw_fault(self):
+        """Return the fault to inject into a request, or None."""
+        with self.lock:
+            draw = self.random.random()
+            for fault, rate in (('error', self.error_rate),
+                                ('truncate', self.truncate_rate),
+                                ('reset', self.reset_rate)):
+                if draw < rate:
+                    self.fault_counts[fault] += 1
+                    return fault
+                draw -= rate
+
+        return None
+
+    def throttle(self):
+        """Return True if a request is over the rate limit."""
+        if not self.rate_limit:
+            return False
+
+        with self.lock:
+            now = time.time()
+            self.allowance = min(self.burst, self.allowance +
+                                 (now - self.checked) * self.rate_limit)
+            self.checked = now
+            if self.allowance < 1:
+                self.throttle_count += 1
+                return True
+            self.allowance -= 1
+            return False
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%i/v3' % self.server_address[1]
+
+    def start(self):
+        """Serve requests on a background thread."""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        return self
+
+    def shutdown(self):
+        """Stop serving, and end the connections clients still hold open,
+        so that no handler thread outlives the server.
+        """
+        BaseHTTPServer.HTTPServer.shutdown(self)
+        with self.lock:
+            handlers = self.handlers.items()
+        for thread, connection in handlers:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            thread.join(1)
+        self.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Serve synthetic GroupMe chats for testing.')
+    parser.add_argument('port', type=int, nargs='?', default=8000)
+    parser.add_argument('msg_count', type=int, nargs='?', default=1000,
+                        help='messages in each chat (default %(default)s)')
+    parser.add_argument('--groups', type=int, default=1)
+    parser.add_argument('--directs', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds each page of messages takes')
+    parser.add_argument('--jitter', type=float, default=0,
+                        help='most seconds added to the latency at random')
+    parser.add_argument('--rate-limit', type=float,
+                        help='requests/second before throttling with 420')
+    parser.add_argument('--errors', type=float, default=0,
+                        help='fraction of requests answered with 420 or 5xx')
+    parser.add_argument('--truncate', type=float, default=0,
+                        help='fraction of pages cut off partway')
+    parser.add_argument('--resets', type=float, default=0,
+                        help='fraction of connections reset')
+    parser.add_argument('--seed', type=int, help='seed of injected faults')
+    parser.add_argument('--image-url',
+                        help='where attachments link to (default this server)')
+    options = parser.parse_args()
+
+    server = MockServer(options.port, options.msg_count, options.latency,
+                        options.rate_limit, groups=options.groups,
+                        directs=options.directs, jitter=options.jitter,
+                        error_rate=options.errors,
+                        truncate_rate=options.truncate,
+                        reset_rate=options.resets, seed=options.seed,
+                        image_url=options.image_url)
+    print "Serving %i group and %i direct message chats at %s" % (
+        len(server.groups), len(server.directs), server.url)
+    server.serve_forever()
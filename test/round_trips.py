@@ -0,0 +1,236 @@
+"""Round-trip checks of updating, repairing, resuming and rendering chat
+histories.
+
+Each check retrieves a chat from the local stand-in server in
+'mock_server.py' in two steps, the way a user would after new messages or
+a failed retrieval, or renders it again from the archive, and asserts that
+the result is byte for byte the same as a fresh export of the whole chat.
+Run one by name, e.g.
+
+    python round_trips.py update
+
+or every check with no arguments.
+"""
+import sys
+import os
+import imp
+import glob
+import shutil
+import socket
+import tempfile
+import urllib2
+
+from mock_server import MockServer
+
+app = imp.load_source('get_chat_history', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..',
+    'get_chat_history_v1.1.py'))
+app.limiter = app.RateLimiter(1e9, 1e9)
+
+self_id = '1001'
+
+
+def set_messages(server, messages):
+    """Make the server's first group hold only the given messages."""
+    chat = server.groups[0]
+    chat.messages = messages
+    chat.index = dict((m['id'], i) for i, m in enumerate(messages))
+
+
+def export(name, compression=None):
+    """Export the first group as HTML and rename the file to 'name'."""
+    app.export_chat('x', self_id, 'group', '1', compression=compression)
+    written = glob.glob('1_group_chat_history_*.html*')
+    assert len(written) == 1, written
+    os.rename(written[0], name)
+
+
+def read_history(name):
+    f = app.open_history(name)
+    data = f.read()
+    f.close()
+    return data
+
+
+def failing_pages(pages, error):
+    """Return a get_page() that raises 'error' after 'pages' pages."""
+    get_page = app.get_page
+    calls = [0]
+
+    def failing(url, cancel=None):
+        calls[0] += 1
+        if calls[0] > pages:
+            raise error
+        return get_page(url, cancel)
+
+    return failing
+
+
+def start(msg_count):
+    """Start a server with one group and move to a temporary directory."""
+    server = MockServer(msg_count=msg_count).start()
+    app.api_url = server.url
+    cwd = os.getcwd()
+    tmp = tempfile.mkdtemp()
+    os.chdir(tmp)
+    export('fresh.html')
+    return server, cwd, tmp
+
+
+def stop(server, cwd, tmp):
+    os.chdir(cwd)
+    shutil.rmtree(tmp)
+    app.pool.close()
+    server.shutdown()
+
+
+def check_update(msg_count=1234, added=(1, 100, 567)):
+    """Update a history missing its latest messages with update_chat()."""
+    server, cwd, tmp = start(msg_count)
+    messages = server.groups[0].messages
+    fresh = read_history('fresh.html')
+    try:
+        for count in added:
+            for compression in (None, 'gzip'):
+                name = 'old.html%s' % app.compressed_suffixes.get(
+                    compression, '')
+                set_messages(server, messages[:-count])
+                export(name, compression)
+                set_messages(server, messages)
+
+                assert app.update_chat('x', self_id, name) == count
+                assert read_history(name) == fresh, (count, compression)
+                os.remove(name)
+            print 'update of %i messages ok' % count
+    finally:
+        stop(server, cwd, tmp)
+
+
+def check_repair(msg_count=1234, pages=(1, 4, 11)):
+    """Repair a history cut short by an API error with repair_chat(). A
+    history with its attachments downloaded is repaired with them linked,
+    without 'download_media' set.
+    """
+    server, cwd, tmp = start(msg_count)
+    fresh = read_history('fresh.html')
+    get_page = app.get_page
+    max_retries = app.max_retries
+    app.max_retries = 0
+    try:
+        app.download_media = True
+        export('linked.html')
+        app.download_media = False
+        linked = read_history('linked.html')
+
+        for count in pages:
+            for compression, media in ((None, False), ('gzip', False),
+                                       (None, True)):
+                name = 'cut.html%s' % app.compressed_suffixes.get(
+                    compression, '')
+                app.get_page = failing_pages(count, urllib2.HTTPError(
+                    app.api_url, 503, 'Service Unavailable', {}, None))
+                app.download_media = media
+                export(name, compression)
+                app.download_media = False
+                app.get_page = get_page
+                details = app.get_error_details(name).group(1).split()
+
+                # An interrupted repair from another message is not resumed.
+                stale = server.groups[0].messages
+                temp = open('1_chat_history_repair.txt', 'wb')
+                temp.write('<tr><td>from another repair</td></tr>\n')
+                temp.close()
+                app.save_json({
+                    'chat_type': 'group', 'chat_ID': '1',
+                    'msg_ID': stale[-1]['id'], 'before_id': stale[-2]['id'],
+                    'size': os.path.getsize('1_chat_history_repair.txt'),
+                    'day': 0, 'date': ' '.join(details[3:]),
+                    'update_details': '', 'msg_count': len(stale) - 2,
+                    'render': True},
+                    app.get_checkpoint_name('1', details[2]))
+
+                fixed = app.repair_chat('x', self_id, name)
+                assert fixed.endswith(name[len('cut'):]), fixed
+                assert read_history(fixed) == (linked if media else fresh), (
+                    count, compression, media)
+                assert sorted(os.listdir('.')) == sorted(
+                    ['fresh.html', 'linked.html', fixed, app.archive_name,
+                     app.estimates_name, app.media_dir])
+                os.remove(fixed)
+            print 'repair after %i pages ok' % count
+    finally:
+        app.get_page = get_page
+        app.max_retries = max_retries
+        app.download_media = False
+        stop(server, cwd, tmp)
+
+
+def check_resume(msg_count=1234, pages=(1, 6)):
+    """Resume a retrieval killed partway through from its checkpoint."""
+    server, cwd, tmp = start(msg_count)
+    fresh = read_history('fresh.html')
+    get_page = app.get_page
+    checkpoint_interval = app.checkpoint_interval
+    app.checkpoint_interval = 0
+    checkpoint_name = app.get_checkpoint_name('1', None)
+    try:
+        for count in pages:
+            app.get_page = failing_pages(count, socket.error('killed'))
+            try:
+                export('resumed.html')
+            except socket.error:
+                pass
+            else:
+                raise AssertionError('the retrieval was not killed')
+            app.get_page = get_page
+            assert os.path.isfile(checkpoint_name)
+
+            # Text written after the last checkpoint is thrown away.
+            temp = open('1_chat_history.txt', 'ab')
+            temp.write('<tr><td>written after the checkpoint</td></tr>\n')
+            temp.close()
+
+            export('resumed.html')
+            assert read_history('resumed.html') == fresh, count
+            assert not os.path.exists(checkpoint_name)
+            assert not os.path.exists('1_chat_history.txt')
+            os.remove('resumed.html')
+            print 'resume after %i pages ok' % count
+    finally:
+        app.get_page = get_page
+        app.checkpoint_interval = checkpoint_interval
+        stop(server, cwd, tmp)
+
+
+def check_render(msg_count=1234):
+    """Render an exported chat again from the archive with render_history(),
+    without any requests.
+    """
+    server, cwd, tmp = start(msg_count)
+    fresh = read_history('fresh.html')
+    archive = app.open_archive()
+    try:
+        for compression in (None, 'gzip'):
+            request_count = server.request_count
+            name = app.render_history(archive, self_id, 'group', '1',
+                                      compression)
+            assert server.request_count == request_count
+            assert read_history(name) == fresh, compression
+            os.remove(name)
+            print 'render of %s ok' % (compression or 'plain HTML')
+    finally:
+        archive.close()
+        stop(server, cwd, tmp)
+
+
+checks = {
+    'render': check_render,
+    'repair': check_repair,
+    'resume': check_resume,
+    'update': check_update,
+}
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or sorted(checks)
+    for name in names:
+        checks[name]()